@@ -0,0 +1,208 @@
+import math
+import random
+import zipfile
+import argparse
+from pathlib import Path
+from typing import List, NamedTuple, Tuple
+from xml.sax.saxutils import escape
+
+# Fixed zip timestamps so the same spec and seed always produce the same bytes.
+ZIP_DATE = (2020, 1, 1, 0, 0, 0)
+TOC_FANOUT = 4
+
+LATIN_WORDS = (
+    'lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore '
+    'et dolore magna aliqua enim ad minim veniam quis nostrud exercitation ullamco laboris nisi aliquip '
+    'ex ea commodo consequat duis aute irure in reprehenderit voluptate velit esse cillum fugiat nulla'
+).split()
+CJK_CHARS = (
+    '天地玄黄宇宙洪荒日月盈昃辰宿列张寒来暑往秋收冬藏闰余成岁律吕调阳云腾致雨露结为霜金生丽水玉出昆冈'
+    '剑号巨阙珠称夜光果珍李柰菜重芥姜海咸河淡鳞潜羽翔龙师火帝鸟官人皇始制文字乃服衣裳推位让国有虞陶唐'
+)
+CJK_PUNCT = '，。、；！？'
+
+CSS = b'''@font-face { font-family: "Body"; src: url(../Fonts/body.ttf); }
+body { font-family: "Body", serif; line-height: 1.6; }
+p { text-indent: 2em; margin: 0; }
+.note { font-size: 0.8em; }
+'''
+
+
+class BookSpec(NamedTuple):
+    chapters: int = 20
+    chapter_kb: int = 32
+    script: str = 'cjk'
+    images: int = 0
+    image_kb: int = 16
+    toc_depth: int = 1
+
+
+DEFAULT_SPEC = BookSpec()
+TocNode = Tuple[str, str, list]
+
+
+def make_sentence(rng: random.Random, script: str) -> str:
+    if script == 'mixed':
+        script = rng.choice(('cjk', 'latin'))
+    if script == 'cjk':
+        return ''.join(rng.choice(CJK_CHARS) for _ in range(rng.randint(8, 30))) + rng.choice(CJK_PUNCT)
+    words = [rng.choice(LATIN_WORDS) for _ in range(rng.randint(6, 18))]
+    return ' '.join(words).capitalize() + '. '
+
+
+def make_chapter(rng: random.Random, spec: BookSpec, index: int, images: List[str]) -> bytes:
+    target = spec.chapter_kb * 1024
+    parts = [f'<h1 id="ch{index}">Chapter {index}</h1>\n']
+    size = len(parts[0])
+    para = 0
+    while size < target:
+        sentences = [make_sentence(rng, spec.script) for _ in range(rng.randint(2, 6))]
+        if rng.random() < 0.3:
+            sentences[0] = f'<em>{sentences[0]}</em>'
+        if rng.random() < 0.1:
+            sentences[-1] = f'<a href="ch{max(index - 1, 1)}.xhtml#p{para}" class="note">{sentences[-1]}</a>'
+        p = f'<p id="p{para}" class="body" style="margin:0">{"".join(sentences)}</p>\n'
+        if images and rng.random() < 0.05:
+            p += f'<div class="figure"><img src="../Images/{rng.choice(images)}" alt=""/></div>\n'
+        parts.append(p)
+        size += len(p.encode('utf-8'))
+        para += 1
+    lang = 'zh' if spec.script == 'cjk' else 'en'
+    return (
+        '<?xml version="1.0" encoding="utf-8"?>\n'
+        f'<html xmlns="http://www.w3.org/1999/xhtml" xml:lang="{lang}">\n'
+        f'<head><title>Chapter {index}</title>'
+        '<link rel="stylesheet" type="text/css" href="../Styles/style.css"/></head>\n'
+        f'<body>\n{"".join(parts)}</body>\n</html>\n'
+    ).encode('utf-8')
+
+
+def make_image(rng: random.Random, kb: int) -> bytes:
+    return b'\x89PNG\r\n\x1a\n' + rng.randbytes(kb * 1024)
+
+
+def build_toc(chapters: List[Tuple[str, str]], depth: int) -> List[TocNode]:
+    if depth <= 1 or len(chapters) <= 1:
+        return [(title, href, []) for title, href in chapters]
+    per_part = math.ceil(len(chapters) / TOC_FANOUT)
+    nodes = []
+    for n, start in enumerate(range(0, len(chapters), per_part), 1):
+        part = chapters[start:start + per_part]
+        nodes.append((f'Part {n}', part[0][1], build_toc(part, depth - 1)))
+    return nodes
+
+
+def render_nav(toc: List[TocNode]) -> str:
+    def walk(nodes: List[TocNode]) -> str:
+        items = ''.join(
+            f'<li><a href="{escape(href)}">{escape(title)}</a>{walk(children) if children else ""}</li>'
+            for title, href, children in nodes)
+        return f'<ol>{items}</ol>'
+
+    return (
+        '<?xml version="1.0" encoding="utf-8"?>\n'
+        '<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops">\n'
+        '<head><title>Contents</title></head>\n'
+        f'<body><nav epub:type="toc" id="toc">{walk(toc)}</nav></body>\n</html>\n'
+    )
+
+
+def render_ncx(title: str, toc: List[TocNode]) -> str:
+    counter = [0]
+
+    def walk(nodes: List[TocNode]) -> str:
+        out = []
+        for label, href, children in nodes:
+            counter[0] += 1
+            out.append(
+                f'<navPoint id="np{counter[0]}" playOrder="{counter[0]}">'
+                f'<navLabel><text>{escape(label)}</text></navLabel><content src="{escape(href)}"/>'
+                f'{walk(children)}</navPoint>')
+        return ''.join(out)
+
+    return (
+        '<?xml version="1.0" encoding="utf-8"?>\n'
+        '<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">\n'
+        f'<head/><docTitle><text>{escape(title)}</text></docTitle>\n'
+        f'<navMap>{walk(toc)}</navMap>\n</ncx>\n'
+    )
+
+
+def render_opf(title: str, ident: str, spec: BookSpec, chapters: List[str], images: List[str]) -> str:
+    lang = 'zh' if spec.script == 'cjk' else 'en'
+    items = [
+        '<item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>',
+        '<item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>',
+        '<item id="style" href="Styles/style.css" media-type="text/css"/>',
+        '<item id="font" href="Fonts/body.ttf" media-type="application/x-font-ttf"/>',
+    ]
+    items += [f'<item id="{c[:-6]}" href="Text/{c}" media-type="application/xhtml+xml"/>' for c in chapters]
+    items += [f'<item id="img{i}" href="Images/{name}" media-type="image/png"/>' for i, name in enumerate(images)]
+    cover = '<meta name="cover" content="img0"/>' if images else ''
+    spine = ''.join(f'<itemref idref="{c[:-6]}"/>' for c in chapters)
+    return (
+        '<?xml version="1.0" encoding="utf-8"?>\n'
+        '<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="id">\n'
+        '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">'
+        f'<dc:identifier id="id">{ident}</dc:identifier><dc:title>{escape(title)}</dc:title>'
+        f'<dc:language>{lang}</dc:language><dc:creator>Bench Author</dc:creator>{cover}</metadata>\n'
+        f'<manifest>\n{chr(10).join(items)}\n</manifest>\n'
+        f'<spine toc="ncx">{spine}</spine>\n</package>\n'
+    )
+
+
+def make_epub(path: Path, spec: BookSpec, seed: int = 0, title: str = '') -> None:
+    rng = random.Random(f'{seed}:{path.stem}')
+    title = title or path.stem
+    images = [f'image{i}.png' for i in range(spec.images)]
+    chapters = [f'ch{i}.xhtml' for i in range(1, spec.chapters + 1)]
+    toc = build_toc([(f'Chapter {i}', f'Text/{c}') for i, c in enumerate(chapters, 1)], spec.toc_depth)
+
+    def add(zf: zipfile.ZipFile, name: str, data, compress: int = zipfile.ZIP_DEFLATED) -> None:
+        zf.writestr(zipfile.ZipInfo(name, ZIP_DATE), data, compress_type=compress)
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with zipfile.ZipFile(path, 'w') as zf:
+        add(zf, 'mimetype', 'application/epub+zip', zipfile.ZIP_STORED)
+        add(zf, 'META-INF/container.xml',
+            '<?xml version="1.0"?>\n<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">'
+            '<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>'
+            '</rootfiles></container>\n')
+        add(zf, 'OEBPS/content.opf', render_opf(title, f'urn:bench:{seed}:{path.stem}', spec, chapters, images))
+        add(zf, 'OEBPS/nav.xhtml', render_nav(toc))
+        add(zf, 'OEBPS/toc.ncx', render_ncx(title, toc))
+        add(zf, 'OEBPS/Styles/style.css', CSS)
+        add(zf, 'OEBPS/Fonts/body.ttf', rng.randbytes(8 * 1024))
+        for i, name in enumerate(chapters, 1):
+            add(zf, f'OEBPS/Text/{name}', make_chapter(rng, spec, i, images))
+        for name in images:
+            add(zf, f'OEBPS/Images/{name}', make_image(rng, spec.image_kb), zipfile.ZIP_STORED)
+
+
+def make_corpus(out_dir: Path, books: int, spec: BookSpec, seed: int = 0) -> List[Path]:
+    paths = [out_dir / f'book{n:03d}.epub' for n in range(1, books + 1)]
+    for n, path in enumerate(paths, 1):
+        make_epub(path, spec, seed, title=f'Bench Book {n}')
+    return paths
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Generate a deterministic synthetic EPUB corpus')
+    parser.add_argument('-o', '--output', required=True, help='Output directory for EPUB files')
+    parser.add_argument('--books', type=int, default=10, help='Number of books (default: 10)')
+    parser.add_argument('--chapters', type=int, default=DEFAULT_SPEC.chapters, help='Chapters per book')
+    parser.add_argument('--chapter-kb', type=int, default=DEFAULT_SPEC.chapter_kb, help='Approximate chapter size in KB')
+    parser.add_argument('--script', choices=['cjk', 'latin', 'mixed'], default=DEFAULT_SPEC.script, help='Text script')
+    parser.add_argument('--images', type=int, default=DEFAULT_SPEC.images, help='Images per book')
+    parser.add_argument('--image-kb', type=int, default=DEFAULT_SPEC.image_kb, help='Image size in KB')
+    parser.add_argument('--toc-depth', type=int, default=DEFAULT_SPEC.toc_depth, help='Nesting depth of the TOC')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed (default: 0)')
+    args = parser.parse_args()
+
+    spec = BookSpec(args.chapters, args.chapter_kb, args.script, args.images, args.image_kb, args.toc_depth)
+    paths = make_corpus(Path(args.output), args.books, spec, args.seed)
+    print(f"Wrote {len(paths)} EPUB file(s) to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
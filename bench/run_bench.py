@@ -0,0 +1,179 @@
+import sys
+import json
+import time
+import platform
+import resource
+import argparse
+import tempfile
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+
+from make_corpus import DEFAULT_SPEC, BookSpec, make_corpus
+from utils import EpubArchive
+from catalog import BookRecord
+from epub2html import BuildOptions, convert_ebook, create_master_index
+from epub_slimmer import clean_file
+from epub_check import scan_epub
+
+# Each benchmark returns (seconds, bytes processed, items processed); setup is not timed.
+BenchResult = Tuple[float, int, int]
+
+
+def corpus_stats(corpus: List[Path]) -> Tuple[int, int]:
+    nbytes = chapters = 0
+    for path in corpus:
+        with EpubArchive(path) as archive:
+            docs = archive.spine_documents()
+            chapters += len(docs)
+            nbytes += sum(archive.size(item.href) for item in docs)
+    return nbytes, chapters
+
+
+def bench_convert(corpus: List[Path], work: Path, options: BuildOptions = BuildOptions()) -> BenchResult:
+    nbytes, chapters = corpus_stats(corpus)
+    start = time.perf_counter()
+    for path in corpus:
+        convert_ebook(path, work / path.stem, options)
+    return time.perf_counter() - start, nbytes, chapters
+
+
+def bench_convert_search(corpus: List[Path], work: Path) -> BenchResult:
+    return bench_convert(corpus, work, BuildOptions(search=True))
+
+
+def bench_slim(corpus: List[Path], work: Path) -> BenchResult:
+    _, chapters = corpus_stats(corpus)
+    start = time.perf_counter()
+    for path in corpus:
+        clean_file(path, work / path.name)
+    return time.perf_counter() - start, sum(p.stat().st_size for p in corpus), chapters
+
+
+def bench_check(corpus: List[Path], work: Path) -> BenchResult:
+    nbytes, chapters = corpus_stats(corpus)
+    start = time.perf_counter()
+    for path in corpus:
+        scan_epub(path)
+    return time.perf_counter() - start, nbytes, chapters
+
+
+def bench_index(corpus: List[Path], work: Path, entries: int = 5000) -> BenchResult:
+    books = [BookRecord(f'Book {n:05d}', f'books/book{n:05d}/index.html') for n in range(entries, 0, -1)]
+    start = time.perf_counter()
+    create_master_index(work, books)
+    return time.perf_counter() - start, (work / 'index.html').stat().st_size, entries
+
+
+BENCHMARKS: Dict[str, Tuple[Callable[[List[Path], Path], BenchResult], str]] = {
+    'convert_ebook': (bench_convert, 'chapters'),
+    'convert_ebook_search': (bench_convert_search, 'chapters'),
+    'clean_file': (bench_slim, 'chapters'),
+    'scan_epub': (bench_check, 'chapters'),
+    'create_master_index': (bench_index, 'books'),
+}
+
+
+def peak_rss_mb() -> float:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return rss / (1 << 20) if sys.platform == 'darwin' else rss / 1024
+
+
+def run_benchmark(name: str, corpus: List[Path], repeat: int) -> Dict:
+    fn, unit = BENCHMARKS[name]
+    best = None
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory() as work:
+            seconds, nbytes, items = fn(corpus, Path(work))
+        best = seconds if best is None else min(best, seconds)
+    return {
+        'seconds': best,
+        'mb_per_s': nbytes / best / 1e6,
+        f'{unit}_per_s': items / best,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def compare(results: Dict[str, Dict], baseline: Dict[str, Dict], threshold: float) -> List[str]:
+    regressions = []
+    print(f"\n{'benchmark':<22}{'baseline MB/s':>15}{'now MB/s':>12}{'change':>10}")
+    for name, r in results.items():
+        old = baseline.get(name)
+        if not old:
+            continue
+        change = (r['mb_per_s'] / old['mb_per_s'] - 1) * 100
+        flag = ''
+        if change < -threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print(f"{name:<22}{old['mb_per_s']:>15.2f}{r['mb_per_s']:>12.2f}{change:>+9.1f}%{flag}")
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmark the EPUB pipeline on a synthetic corpus')
+    parser.add_argument('--corpus', help='Use EPUB files from this directory instead of generating a corpus')
+    parser.add_argument('--books', type=int, default=8, help='Number of generated books (default: 8)')
+    parser.add_argument('--chapters', type=int, default=40, help='Chapters per generated book (default: 40)')
+    parser.add_argument('--chapter-kb', type=int, default=32, help='Approximate chapter size in KB (default: 32)')
+    parser.add_argument('--script', choices=['cjk', 'latin', 'mixed'], default='cjk', help='Text script')
+    parser.add_argument('--images', type=int, default=4, help='Images per generated book (default: 4)')
+    parser.add_argument('--toc-depth', type=int, default=2, help='TOC nesting depth (default: 2)')
+    parser.add_argument('--seed', type=int, default=0, help='Corpus random seed (default: 0)')
+    parser.add_argument('-b', '--bench', action='append', choices=sorted(BENCHMARKS),
+                        help='Benchmark to run; repeat for several (default: all)')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='Runs per benchmark; the best is kept (default: 3)')
+    parser.add_argument('--save', metavar='PATH', help='Write results to PATH as JSON')
+    parser.add_argument('--baseline', metavar='PATH', help='Compare against results saved with --save')
+    parser.add_argument('--threshold', type=float, default=10,
+                        help='Exit non-zero if MB/s drops by more than this percent vs the baseline (default: 10)')
+    args = parser.parse_args()
+
+    spec = BookSpec(args.chapters, args.chapter_kb, args.script, args.images, DEFAULT_SPEC.image_kb, args.toc_depth)
+    names = args.bench or list(BENCHMARKS)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.corpus:
+            corpus = sorted(Path(args.corpus).glob('*.epub'))
+        else:
+            corpus = make_corpus(Path(tmp), args.books, spec, args.seed)
+        if not corpus:
+            print("No EPUB files to benchmark")
+            sys.exit(1)
+
+        results = {}
+        print(f"{'benchmark':<22}{'seconds':>10}{'MB/s':>10}{'items/s':>12}{'peak RSS MB':>14}")
+        for name in names:
+            # A fresh process per benchmark so peak RSS is not inherited from the previous one.
+            with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+                r = executor.submit(run_benchmark, name, corpus, args.repeat).result()
+            results[name] = r
+            rate = next(v for k, v in r.items() if k.endswith('_per_s') and k != 'mb_per_s')
+            print(f"{name:<22}{r['seconds']:>10.3f}{r['mb_per_s']:>10.2f}{rate:>12.1f}{r['peak_rss_mb']:>14.1f}")
+
+    report = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'corpus': args.corpus or dict(spec._asdict(), books=args.books, seed=args.seed),
+        'results': results,
+    }
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=1)
+        print(f"\nSaved results to {args.save}")
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline: Optional[Dict] = json.load(f)
+        if baseline.get('corpus') != report['corpus']:
+            print("Warning: baseline was recorded on a different corpus")
+        if compare(results, baseline.get('results', {}), args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+import sys
+import argparse
+from contextlib import nullcontext
+from typing import List, Optional
+
+from profiling import ImportTimer
+
+# Command -> (module, description). A command's module, and whatever it needs, is only
+# imported once that command runs, so `books --help` loads none of them.
+COMMANDS = {
+    'convert': ('epub2html', 'Convert EPUB files to an HTML bookshelf'),
+    'slim': ('epub_slimmer', 'Shrink EPUB files by dropping unused and oversized resources'),
+    'check': ('epub_check', 'Scan EPUB files for structure, link and metadata issues'),
+    'edit': ('edit_epub', 'Rename titles and chapters in EPUB files'),
+}
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        prog='books', description='EPUB bookshelf tools',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog='commands:\n' + '\n'.join(f'  {name:<10}{desc}' for name, (_, desc) in COMMANDS.items())
+               + '\n\nRun "books COMMAND --help" for the options of a command.')
+    parser.add_argument('--import-profile', action='store_true',
+                        help='Report time spent importing modules, by package, on stderr when the command ends')
+    parser.add_argument('command', choices=list(COMMANDS), metavar='COMMAND')
+    parser.add_argument('args', nargs=argparse.REMAINDER, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    timer = ImportTimer()
+    try:
+        with timer if args.import_profile else nullcontext():
+            # __import__ rather than importlib, so the timer sees the command module itself.
+            module = __import__(COMMANDS[args.command][0])
+            # The command parses sys.argv itself; this makes its usage read "books COMMAND".
+            sys.argv = [f'{parser.prog} {args.command}'] + args.args
+            module.main()
+    finally:
+        if args.import_profile:
+            print(timer.summary(), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
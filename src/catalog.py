@@ -0,0 +1,34 @@
+from typing import Iterable, Iterator, List, NamedTuple, Tuple
+
+from utils import TocEntry
+
+UNKNOWN_GROUP = 'Unknown'
+
+
+class BookRecord(NamedTuple):
+    title: str
+    path: str
+    author: str = ''
+    language: str = ''
+
+
+def iter_toc(toc: List[TocEntry], depth: int = 0) -> Iterator[Tuple[TocEntry, int]]:
+    # Depth-first with an explicit stack, so deep TOCs neither recurse nor get copied.
+    stack = [(iter(toc), depth)]
+    while stack:
+        entries, depth = stack[-1]
+        entry = next(entries, None)
+        if entry is None:
+            stack.pop()
+            continue
+        yield entry, depth
+        if entry[2]:
+            stack.append((iter(entry[2]), depth + 1))
+
+
+def group_books(books: Iterable[BookRecord], field: str) -> List[Tuple[str, List[BookRecord]]]:
+    # Groups in name order with books missing the field last; books keep their given order.
+    groups = {}
+    for book in books:
+        groups.setdefault(getattr(book, field) or UNKNOWN_GROUP, []).append(book)
+    return sorted(groups.items(), key=lambda g: (g[0] == UNKNOWN_GROUP, g[0].lower()))
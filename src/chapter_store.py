@@ -0,0 +1,117 @@
+import os
+import json
+import hashlib
+from collections import Counter
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+STORE_DIR = 'store'
+REPORT_NAME = 'dedup-report.json'
+
+
+def store_href(key: str) -> str:
+    return f'{STORE_DIR}/{key[:2]}/{key}.html'
+
+
+class ChapterStore:
+    # Sanitized chapter bodies keyed by a hash of the source document, shared by every
+    # book in the output tree. A hit skips sanitizing entirely; the search token counts
+    # are kept next to the body so the index does not need the text again.
+
+    def __init__(self, root: Path, salt: str = ''):
+        self.root = root
+        self.salt = salt.encode('utf-8')
+        self.keys: List[str] = []
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, raw: bytes) -> str:
+        return hashlib.sha256(self.salt + raw).hexdigest()
+
+    def path(self, key: str, suffix: str = '.html') -> Path:
+        return self.root / key[:2] / f'{key}{suffix}'
+
+    def href(self, key: str) -> str:
+        return store_href(key)
+
+    def lookup(self, key: str, need_counts: bool) -> Tuple[bool, Optional[Counter]]:
+        body = self.path(key)
+        counts_path = self.path(key, '.json')
+        if not body.exists() or (need_counts and not counts_path.exists()):
+            return False, None
+        counts = None
+        if need_counts:
+            with open(counts_path, 'r', encoding='utf-8') as f:
+                counts = Counter(json.load(f))
+        return True, counts
+
+    def add(self, key: str, render: Callable[[Callable[[str], object]], Optional[Counter]]) -> Optional[Counter]:
+        # Workers may race on the same key; each writes its own tmp files and the last
+        # rename wins with identical content. The body is renamed last so a visible body
+        # always has its counts next to it.
+        body = self.path(key)
+        body.parent.mkdir(parents=True, exist_ok=True)
+        tmp = body.with_name(f'{body.name}.{os.getpid()}.tmp')
+        with open(tmp, 'w', encoding='utf-8') as f:
+            counts = render(f.write)
+        if counts is not None:
+            counts_tmp = body.with_name(f'{key}.json.{os.getpid()}.tmp')
+            with open(counts_tmp, 'w', encoding='utf-8') as f:
+                json.dump(counts, f, ensure_ascii=False, separators=(',', ':'))
+            os.replace(counts_tmp, self.path(key, '.json'))
+        os.replace(tmp, body)
+        return counts
+
+    def record(self, key: str, hit: bool) -> None:
+        self.keys.append(key)
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def stats(self) -> Dict:
+        return {'keys': self.keys, 'hits': self.hits, 'misses': self.misses}
+
+
+def merge_stats(a: Optional[Dict], b: Optional[Dict]) -> Optional[Dict]:
+    if not a or not b:
+        return a or b
+    return {'keys': a['keys'] + b['keys'], 'hits': a['hits'] + b['hits'], 'misses': a['misses'] + b['misses']}
+
+
+def prune_store(root: Path, referenced: Iterable[str]) -> int:
+    keep = set(referenced)
+    removed = 0
+    if not root.exists():
+        return removed
+    for path in root.glob('*/*'):
+        if path.name.split('.', 1)[0] not in keep:
+            path.unlink()
+            removed += 1
+    for folder in [*root.glob('*/'), root]:
+        if not any(folder.iterdir()):
+            folder.rmdir()
+    return removed
+
+
+def write_dedup_report(output_dir: Path, books: Dict[str, List[str]]) -> Dict:
+    # Computed from what the shelf references rather than from this build's cache hits,
+    # so the numbers do not depend on build order or on what earlier builds left behind.
+    # Only bodies referenced more than once are in the store; the rest stay inline.
+    root = output_dir / STORE_DIR
+    refs = Counter(key for keys in books.values() for key in keys)
+    sizes = {key: (root / key[:2] / f'{key}.html').stat().st_size for key, n in refs.items() if n > 1}
+    report = {
+        'chapters': sum(refs.values()),
+        'unique': len(refs),
+        'stored': len(sizes),
+        'stored_bytes': sum(sizes.values()),
+        'saved_bytes': sum(size * (refs[key] - 1) for key, size in sizes.items()),
+        'books': {
+            name: {'chapters': len(keys), 'shared': sum(1 for key in keys if refs[key] > 1)}
+            for name, keys in sorted(books.items())
+        },
+    }
+    with open(output_dir / REPORT_NAME, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=1)
+    return report
@@ -1,17 +1,33 @@
+import os
+import re
 import sys
+import json
+import fnmatch
 import tempfile
 import argparse
 import logging
+import zipfile
 from pathlib import Path
-from typing import List
-from ebooklib import epub
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
 
-from utils import read_epub_safe, get_epub_title
+from utils import NAMESPACES, EpubArchive, copy_zip_member, read_epub_safe, replace_zip_member, get_epub_title
+
+# ebooklib is only imported by the interactive editor and lxml by the spec patches, so
+# --help loads neither and spec workers never load ebooklib.
+if TYPE_CHECKING:
+    from lxml import etree
+    from ebooklib import epub
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
 
 logger = logging.getLogger(__name__)
 
 
-def collect_links(items: list, all_links: List[epub.Link]) -> None:
+def collect_links(items: list, all_links: List['epub.Link']) -> None:
+    from ebooklib import epub
     for item in items:
         if isinstance(item, tuple):
             if len(item) > 0 and isinstance(item[0], epub.Link):
@@ -22,7 +38,7 @@ def collect_links(items: list, all_links: List[epub.Link]) -> None:
             all_links.append(item)
 
 
-def edit_title(book: epub.EpubBook) -> bool:
+def edit_title(book: 'epub.EpubBook') -> bool:
     current_title = get_epub_title(book)
     print(f"\n[Title Editing]\nCurrent title: {current_title}")
     new_title = input("Enter new title (Enter to skip): ").strip()
@@ -35,7 +51,7 @@ def edit_title(book: epub.EpubBook) -> bool:
     return False
 
 
-def edit_chapters(all_links: List[epub.Link]) -> bool:
+def edit_chapters(all_links: List['epub.Link']) -> bool:
     modified = False
     while True:
         print("\n[Chapter Editing]")
@@ -65,7 +81,8 @@ def edit_chapters(all_links: List[epub.Link]) -> bool:
     return modified
 
 
-def save_epub(book: epub.EpubBook, save_path: Path) -> None:
+def save_epub(book: 'epub.EpubBook', save_path: Path) -> None:
+    from ebooklib import epub
     with tempfile.NamedTemporaryFile(mode='wb', delete=False, suffix='.epub') as tmp_file:
         temp_path = Path(tmp_file.name)
 
@@ -94,7 +111,7 @@ def run_editor(epub_path: Path) -> None:
 
     title_modified = edit_title(book)
 
-    all_links: List[epub.Link] = []
+    all_links: List['epub.Link'] = []
     collect_links(book.toc, all_links)
 
     chapters_modified = edit_chapters(all_links)
@@ -108,9 +125,203 @@ def run_editor(epub_path: Path) -> None:
         print("No changes made.")
 
 
+def load_spec(path: Path) -> Dict[str, Dict]:
+    # {"<file name or glob>": {"title": ..., "chapters": {"<index>": ...}, "rename": [[pattern, repl], ...]}}
+    with open(path, 'r', encoding='utf-8') as f:
+        if path.suffix.lower() in ('.yaml', '.yml'):
+            if yaml is None:
+                raise ValueError("YAML edit specs need PyYAML (pip install pyyaml)")
+            spec = yaml.safe_load(f)
+        else:
+            spec = json.load(f)
+    if not isinstance(spec, dict) or not all(isinstance(v, dict) for v in spec.values()):
+        raise ValueError("Edit spec must map file names or globs to edits")
+    return spec
+
+
+def edits_for(name: str, spec: Dict[str, Dict]) -> Dict:
+    # Every matching entry applies in spec order; later entries win for title and indices.
+    edit = {'title': None, 'chapters': {}, 'rename': []}
+    for pattern, entry in spec.items():
+        if fnmatch.fnmatch(name, pattern):
+            if entry.get('title'):
+                edit['title'] = entry['title']
+            edit['chapters'].update({int(k): v for k, v in (entry.get('chapters') or {}).items()})
+            edit['rename'] += [tuple(r) for r in entry.get('rename') or []]
+    return edit
+
+
+def set_label(el: 'etree._Element', text: str) -> bool:
+    if ''.join(el.itertext()) == text:
+        return False
+    for child in list(el):
+        el.remove(child)
+    el.text = text
+    return True
+
+
+def relabel(labels: List[Tuple['etree._Element', bool]], edit: Dict) -> bool:
+    # Indices count chapter entries depth-first, the same numbering the interactive editor
+    # shows; section labels that only group other entries get no index but are still renamed.
+    rename = [(re.compile(pattern), repl) for pattern, repl in edit['rename']]
+    modified = False
+    index = 0
+    for el, is_chapter in labels:
+        text = ''.join(el.itertext())
+        if is_chapter:
+            text = edit['chapters'].get(index, text)
+            index += 1
+        for pattern, repl in rename:
+            text = pattern.sub(repl, text)
+        modified |= set_label(el, text)
+    return modified
+
+
+def serialize(root: 'etree._Element') -> bytes:
+    from lxml import etree
+    tree = root.getroottree()
+    return etree.tostring(tree, encoding=tree.docinfo.encoding or 'utf-8', xml_declaration=True)
+
+
+def patch_opf_title(opf: bytes, title: str) -> Optional[bytes]:
+    from lxml import etree
+    root = etree.fromstring(opf, etree.XMLParser(resolve_entities=False))
+    titles = root.findall('{%s}metadata/{%s}title' % (NAMESPACES['OPF'], NAMESPACES['DC']))
+    if not titles or (len(titles) == 1 and titles[0].text == title):
+        return None
+    titles[0].text = title
+    for el in titles[1:]:
+        el.getparent().remove(el)
+    return serialize(root)
+
+
+def patch_ncx(ncx: bytes, edit: Dict) -> Optional[bytes]:
+    from lxml import etree
+    root = etree.fromstring(ncx, etree.XMLParser(resolve_entities=False))
+    ns = NAMESPACES['NCX']
+    # As in ebooklib, a navPoint with children is a section rather than a chapter.
+    labels = [(point.find('{%s}navLabel/{%s}text' % (ns, ns)), point.find('{%s}navPoint' % ns) is None)
+              for point in root.iter('{%s}navPoint' % ns)]
+    modified = relabel([(el, is_chapter) for el, is_chapter in labels if el is not None], edit)
+    doc_title = root.find('{%s}docTitle/{%s}text' % (ns, ns))
+    if edit['title'] and doc_title is not None:
+        modified |= set_label(doc_title, edit['title'])
+    return serialize(root) if modified else None
+
+
+def patch_nav(nav: bytes, edit: Dict) -> Optional[bytes]:
+    from lxml import etree
+    root = etree.fromstring(nav, etree.XMLParser(resolve_entities=False))
+    navs = root.xpath("//*[local-name()='nav'][@*='toc']")
+    ol = navs[0].find('{*}ol') if navs else None
+    if ol is None:
+        return None
+
+    # Mirrors ebooklib's nav parsing: an entry with a nested list is a section, the
+    # rest are the chapter links the interactive editor numbers.
+    def walk(ol) -> List[Tuple['etree._Element', bool]]:
+        labels = []
+        for li in ol.findall('{*}li'):
+            sub, a = li.find('{*}ol'), li.find('{*}a')
+            if sub is not None:
+                labels.append((li[0], False))
+                labels += walk(sub)
+            elif a is not None and a.get('href'):
+                labels.append((a, True))
+        return labels
+
+    return serialize(root) if relabel(walk(ol), edit) else None
+
+
+def apply_edits(epub_path: Path, edit: Dict) -> int:
+    # Only the OPF, NCX and nav are rewritten; every other member is copied still compressed.
+    patched: Dict[str, bytes] = {}
+    with EpubArchive(epub_path) as archive:
+        if edit['title']:
+            data = patch_opf_title(archive.zf.read(archive.opf_path), edit['title'])
+            if data is not None:
+                patched[archive.opf_path] = data
+        toc_files = [(item, patch_nav) for item in archive.manifest.values() if 'nav' in item.properties]
+        toc_files += [(item, patch_ncx) for item in archive.manifest.values()
+                      if item.media_type == 'application/x-dtbncx+xml']
+        for item, patch in toc_files:
+            data = patch(archive.read(item.href), edit)
+            if data is not None:
+                patched[archive.zip_name(item.href)] = data
+        if not patched:
+            return 0
+
+        tmp_path = epub_path.with_name(epub_path.name + '.tmp')
+        try:
+            with zipfile.ZipFile(tmp_path, 'w') as zout:
+                for info in archive.zf.infolist():
+                    if info.filename in patched:
+                        replace_zip_member(zout, info, patched[info.filename])
+                    else:
+                        copy_zip_member(archive.zf, zout, info)
+            os.replace(tmp_path, epub_path)
+        finally:
+            if tmp_path.exists():
+                tmp_path.unlink()
+    return len(patched)
+
+
+def process_edit(args: Tuple[Path, Dict]) -> Optional[Tuple[str, int]]:
+    epub_path, edit = args
+    try:
+        return epub_path.name, apply_edits(epub_path, edit)
+    except Exception as e:
+        logger.error(f"Failed {epub_path.name}: {e}")
+        return None
+
+
+def run_batch(input_path: Path, spec_path: Path, jobs: int = 1) -> bool:
+    try:
+        spec = load_spec(spec_path)
+    except Exception as e:
+        logger.error(f"Invalid edit spec {spec_path}: {e}")
+        return False
+    files = [input_path] if input_path.is_file() else sorted(input_path.glob('*.epub'))
+    tasks = []
+    for f in files:
+        edit = edits_for(f.name, spec)
+        if edit['title'] or edit['chapters'] or edit['rename']:
+            tasks.append((f, edit))
+    if not tasks:
+        logger.warning(f"No EPUB files in {input_path} match the edit spec")
+        return True
+
+    logger.info(f"Editing {len(tasks)} file(s)...")
+    ok = True
+
+    def report(result: Optional[Tuple[str, int]]) -> None:
+        nonlocal ok
+        if result is None:
+            ok = False
+        elif result[1]:
+            print(f"Updated {result[0]}: {result[1]} member(s) patched")
+        else:
+            print(f"Unchanged {result[0]}")
+
+    if len(tasks) == 1 or jobs == 1:
+        for task in tasks:
+            report(process_edit(task))
+    else:
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+        with ProcessPoolExecutor(max_workers=min(jobs, len(tasks))) as executor:
+            futures = [executor.submit(process_edit, task) for task in tasks]
+            for future in as_completed(futures):
+                report(future.result())
+    return ok
+
+
 def main() -> None:
     parser = argparse.ArgumentParser(description='Edit EPUB metadata and chapter titles')
-    parser.add_argument('-i', '--input', required=True, help='Input EPUB file path')
+    parser.add_argument('-i', '--input', required=True,
+                        help='Input EPUB file path (a file or directory with --spec)')
+    parser.add_argument('--spec', metavar='PATH',
+                        help='Apply the edits in this JSON/YAML spec in place instead of prompting')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of parallel jobs with --spec (default: 1)')
     parser.add_argument('-v', '--verbose', action='store_true', help='Enable verbose logging')
     args = parser.parse_args()
 
@@ -120,6 +331,13 @@ def main() -> None:
     )
 
     epub_path = Path(args.input).resolve()
+    if args.spec:
+        if not epub_path.exists():
+            logger.error(f"Input path does not exist: {epub_path}")
+            sys.exit(1)
+        if not run_batch(epub_path, Path(args.spec).resolve(), args.jobs):
+            sys.exit(1)
+        return
     run_editor(epub_path)
 
 
@@ -1,22 +1,65 @@
 import os
+import re
 import sys
+import gzip
+import json
+import shutil
+import hashlib
+import time
 import argparse
 import logging
-import warnings
 from pathlib import Path
-from typing import List, Dict, Optional, Tuple
-from urllib.parse import urldefrag
-from concurrent.futures import ProcessPoolExecutor, as_completed
-import ebooklib
-from ebooklib import epub
-from bs4 import BeautifulSoup, XMLParsedAsHTMLWarning
-
-from utils import natural_sort_key, read_epub_safe, get_epub_title
-
-warnings.filterwarnings("ignore", category=XMLParsedAsHTMLWarning)
+from collections import Counter
+from typing import AbstractSet, Iterable, Iterator, List, Dict, NamedTuple, Optional, Sequence, Tuple
+from urllib.parse import unquote, urldefrag
+
+from utils import (EpubArchive, Scheduler, Task, add_scheduler_args, scheduler_from_args, natural_sort_key,
+                   get_epub_metadata, get_epub_title, file_sha256, decode_document)
+from sanitizer import SANITIZERS, Paginator
+from search_index import SHARD_NAME, LIBRARY_INDEX_NAME, BookIndex, ChapterTokenizer, write_library_index
+from profiling import StageTimer, write_report
+from catalog import BookRecord, group_books
+from chapter_store import (STORE_DIR, REPORT_NAME, ChapterStore, merge_stats, prune_store, store_href,
+                           write_dedup_report)
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 logger = logging.getLogger(__name__)
 BASE_TPL_DIR = Path(__file__).parent.parent / 'templates'
+CONVERTER_VERSION = '7'
+MANIFEST_NAME = '.manifest.json'
+BOOK_IR_NAME = '.book.json'
+ASSETS_NAME = 'assets.json'
+SW_NAME = 'sw.js'
+TEMPLATE_SUFFIXES = ('.html', '.js')
+PLACEHOLDER_RE = re.compile(r'\{(\w+)\}')
+TPL_INDENT_RE = re.compile(r'\s*\n\s*')
+
+# (output file, previous output file, next output file, document href, uncompressed size, pages)
+Chapter = Tuple[str, Optional[str], Optional[str], str, int, int]
+
+
+class BuildOptions(NamedTuple):
+    sanitizer: str = 'lxml'
+    split_bytes: int = 0
+    search: bool = False
+    page_chars: int = 0
+    minify: bool = False
+    compress: bool = False
+    dedup: bool = False
+    group_by: str = ''
+    offline: bool = False
+
+
+# Options that do not change what is written for a book: scheduling and the shelf layout.
+BUILD_ONLY_OPTIONS = ('split_bytes', 'group_by')
+
+
+def template_files() -> List[Path]:
+    return sorted(p for p in BASE_TPL_DIR.iterdir() if p.suffix in TEMPLATE_SUFFIXES)
 
 
 def load_tpl(name: str) -> str:
@@ -24,97 +67,814 @@ def load_tpl(name: str) -> str:
         return f.read()
 
 
-def create_master_index(output_dir: Path, books: List[Dict[str, str]]) -> None:
-    books.sort(key=lambda x: x['title'])
-    items = "".join([f'<li><a href="{b["path"]}">{b["title"]}</a></li>' for b in books])
-    out_file = output_dir / 'index.html'
-    html = load_tpl('layout_shelf.html').replace('{title}', 'My Bookshelf').replace('{content}', items)
-    with open(out_file, 'w', encoding='utf-8') as f:
-        f.write(html)
+def compile_tpl(tpl: str) -> List[str]:
+    # Even indices are literal text, odd indices are placeholder names.
+    return PLACEHOLDER_RE.split(tpl)
+
+
+def render_tpl(segments: List[str], fields: Dict[str, str]) -> List[str]:
+    return [fields.get(s, '{%s}' % s) if i % 2 else s for i, s in enumerate(segments)]
+
+
+def layout_tpl(name: str, options: BuildOptions, tpl: Optional[str] = None) -> List[str]:
+    segments = compile_tpl(tpl if tpl is not None else load_tpl(name))
+    if options.minify:
+        # Layout templates only break lines between tags, so line breaks and indentation can go.
+        segments = [s if i % 2 else TPL_INDENT_RE.sub('', s) for i, s in enumerate(segments)]
+    return segments
+
+
+def precompress(path: Path) -> None:
+    data = path.read_bytes()
+    with open(path.with_name(path.name + '.gz'), 'wb') as f:
+        f.write(gzip.compress(data, 9, mtime=0))
+    if brotli is not None:
+        with open(path.with_name(path.name + '.br'), 'wb') as f:
+            f.write(brotli.compress(data))
+
+
+def write_output(path: Path, parts: Iterable[str], options: BuildOptions) -> None:
+    # Written aside and renamed so a server never sees a half-written page.
+    tmp = path.with_name(path.name + '.tmp')
+    with open(tmp, 'w', encoding='utf-8') as f:
+        f.writelines(parts)
+    os.replace(tmp, path)
+    if options.compress:
+        precompress(path)
+
+
+def remove_output(path: Path) -> None:
+    for p in (path, path.with_name(path.name + '.gz'), path.with_name(path.name + '.br')):
+        p.unlink(missing_ok=True)
+
+
+def offline_head(tpl_offline: Optional[List[str]], sw_src: str, prefetch: Optional[str] = None) -> str:
+    # Registers the shelf's service worker and hints the browser to fetch the next page early.
+    if tpl_offline is None:
+        return ''
+    link = f'<link rel="prefetch" href="{prefetch}">' if prefetch else ''
+    return ''.join(render_tpl(tpl_offline, {'sw': sw_src})) + link
+
+
+def nav_button(label: str, target: Optional[str]) -> str:
+    return f'<div><a href="{target}">{label}</a></div>' if target else f'<div>{label}</div>'
+
+
+NAV_MIDDLE = nav_button('Contents', '../index.html') + nav_button('Bookshelf', '../../../index.html')
+
 
+def page_name(out_name: str, page: int) -> str:
+    return out_name if page == 0 else f"{out_name[:-5]}_{page + 1}.html"
 
-def convert_ebook(epub_path: Path, book_root: Path) -> str:
-    book = read_epub_safe(epub_path)
-    title = get_epub_title(book, fallback=epub_path.stem)
 
-    chapters_dir = book_root / 'chapters'
-    chapters_dir.mkdir(parents=True, exist_ok=True)
+def page_links(chapter: Chapter, page: int) -> Tuple[Optional[str], Optional[str]]:
+    out_name, prev, next_, _, _, pages = chapter
+    prev_name = page_name(out_name, page - 1) if page else prev
+    next_name = page_name(out_name, page + 1) if page < pages - 1 else next_
+    return prev_name, next_name
 
-    items = [i for i in book.get_items_of_type(ebooklib.ITEM_DOCUMENT)]
-    sorted_items = sorted(items, key=lambda x: natural_sort_key(os.path.basename(x.get_name())))
 
-    filenames_map = {os.path.basename(item.get_name()): f"{i+1}.html" for i, item in enumerate(sorted_items)}
-    sorted_orig_names = [os.path.basename(item.get_name()) for item in sorted_items]
+def page_nav(chapter: Chapter, page: int) -> str:
+    prev_name, next_name = page_links(chapter, page)
+    return nav_button('Prev', prev_name) + NAV_MIDDLE + nav_button('Next', next_name)
 
-    tpl_chapter = load_tpl('layout_chapter.html')
-    for item in sorted_items:
-        orig_fname = os.path.basename(item.get_name())
-        out_fname = filenames_map[orig_fname]
-        out_chap_path = chapters_dir / out_fname
 
-        soup = BeautifulSoup(item.get_content().decode('utf-8', 'ignore'), 'lxml')
+def page_head(tpl_offline: Optional[List[str]], chapter: Chapter, page: int) -> str:
+    return offline_head(tpl_offline, f'../../../{SW_NAME}', page_links(chapter, page)[1])
 
-        for tag in soup.find_all(['img', 'image', 'svg', 'style', 'link', 'script']):
-            tag.decompose()
 
-        for tag in soup.find_all():
-            tag.attrs = {key: val for key, val in tag.attrs.items() if key in ['href', 'id']}
+def page_frame(tpl: List[str], title: str, nav_html: str, head: str = '') -> Tuple[List[str], List[str]]:
+    # The rendered template split around {content}: what goes before and after the body.
+    parts = render_tpl(tpl, {'title': title, 'content': '', 'nav': nav_html, 'head': head})
+    i = tpl.index('content')
+    return parts[:i], parts[i+1:]
 
-        body_content = soup.body.decode_contents() if soup.body else str(soup)
 
-        idx = sorted_orig_names.index(orig_fname)
-        p_html = filenames_map[sorted_orig_names[idx-1]] if idx > 0 else None
-        n_html = filenames_map[sorted_orig_names[idx+1]] if idx < len(sorted_orig_names)-1 else None
+class PageWriter(Paginator):
+    # Streams sanitized content straight into the chapter file, starting a new page file
+    # whenever the sanitizer breaks. With a zero limit it writes the chapter as one page.
+    # Where each body sits in its page is recorded in spans for --rerender.
 
-        btn = lambda lbl, tgt: f'<div><a href="{tgt}">{lbl}</a></div>' if tgt else f'<div>{lbl}</div>'
-        nav_html = f'{btn("Prev", p_html)}{btn("Contents", "../index.html")}{btn("Bookshelf", "../../../index.html")}{btn("Next", n_html)}'
+    def __init__(self, chapters_dir: Path, tpl: List[str], title: str, chapter: Chapter,
+                 limit: int = 0, index: Optional[BookIndex] = None, compress: bool = False,
+                 spans: Optional[Dict] = None, offline: Optional[List[str]] = None):
+        super().__init__(limit)
+        self.compress = compress
+        self.offline = offline
+        self.chapters_dir = chapters_dir
+        self.tpl = tpl
+        self.title = title
+        self.chapter = chapter
+        self.index = index
+        self.spans = spans if spans is not None else {}
+        self.tokenizer = ChapterTokenizer() if index is not None else None
+        self._open()
 
-        final = tpl_chapter.replace('{title}', title).replace('{content}', body_content).replace('{nav}', nav_html)
-        with open(out_chap_path, 'w', encoding='utf-8') as f:
-            f.write(final)
+    def _open(self) -> None:
+        head, self.tail = page_frame(self.tpl, self.title, page_nav(self.chapter, self.page),
+                                     page_head(self.offline, self.chapter, self.page))
+        self.start = sum(map(len, head))
+        self.f = open(self.chapters_dir / page_name(self.chapter[0], self.page), 'w', encoding='utf-8')
+        self.f.writelines(head)
+
+    def _finish(self) -> None:
+        self.f.writelines(self.tail)
+        self.f.close()
+        name = page_name(self.chapter[0], self.page)
+        self.spans[name] = [self.start, self.start + self.size]
+        if self.compress:
+            precompress(Path(self.f.name))
+        if self.tokenizer:
+            self.index.add(name, self.tokenizer.close())
+            self.tokenizer = ChapterTokenizer()
+
+    def write(self, s: str) -> None:
+        self.size += len(s)
+        self.f.write(s)
+
+    def on_text(self, s: str) -> None:
+        self.tokenizer.feed(s)
+
+    def next_page(self) -> None:
+        self._finish()
+        super().next_page()
+        self._open()
+
+    def close(self) -> None:
+        self._finish()
+
+
+def page_limit(raw: bytes, options: BuildOptions) -> int:
+    # Only chapters whose source is over the limit are paginated, so planning and
+    # rendering agree on which chapters get split without sanitizing the rest twice.
+    # The limit is in characters; no source decodes to more characters than it has
+    # bytes, so shorter ones are not decoded.
+    limit = options.page_chars
+    return limit if limit and len(raw) > limit and len(decode_document(raw)) > limit else 0
+
+
+def templates_hash() -> str:
+    h = hashlib.sha256()
+    for tpl in template_files():
+        h.update(tpl.name.encode('utf-8'))
+        h.update(tpl.read_bytes())
+    return h.hexdigest()
+
+
+def load_manifest(output_dir: Path) -> Dict:
+    try:
+        with open(output_dir / MANIFEST_NAME, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        if isinstance(manifest.get('books'), dict):
+            return manifest
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.warning(f"Ignoring unreadable manifest: {e}")
+    return {'books': {}}
+
+
+def save_manifest(output_dir: Path, manifest: Dict) -> None:
+    tmp_file = output_dir / (MANIFEST_NAME + '.tmp')
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1, sort_keys=True)
+    os.replace(tmp_file, output_dir / MANIFEST_NAME)
+
+
+def shelf_records(manifest: Dict) -> List[BookRecord]:
+    return [BookRecord(b['title'], b['path'], b.get('author', ''), b.get('language', ''))
+            for _, b in sorted(manifest['books'].items())]
+
+
+def shelf_items(books: Iterable[BookRecord]) -> str:
+    return "".join([f'<li><a href="{b.path}">{b.title}</a></li>' for b in books])
+
+
+def create_master_index(output_dir: Path, books: Sequence[BookRecord], options: BuildOptions = BuildOptions()) -> None:
+    books = sorted(books, key=lambda b: b.title)
+    if options.group_by:
+        items = "".join([f'<li class="group"><h2>{name}</h2><ul>{shelf_items(group)}</ul></li>'
+                         for name, group in group_books(books, options.group_by)])
+    else:
+        items = shelf_items(books)
+    search_link = '<div class="search"><a href="search.html">Search</a></div>' if options.search else ''
+    tpl_offline = layout_tpl('fragment_offline.html', options) if options.offline else None
+    write_output(output_dir / 'index.html', render_tpl(layout_tpl('layout_shelf.html', options),
+                 {'title': 'My Bookshelf', 'content': items, 'search_link': search_link,
+                  'head': offline_head(tpl_offline, SW_NAME)}), options)
+    if options.offline:
+        write_output(output_dir / SW_NAME, [load_tpl('service_worker.js')], options)
+    else:
+        remove_output(output_dir / SW_NAME)
+    if options.search:
+        write_library_index(output_dir, books)
+        if options.compress:
+            precompress(output_dir / LIBRARY_INDEX_NAME)
+        # Not minified: the inline script relies on its line breaks.
+        write_output(output_dir / 'search.html',
+                     render_tpl(compile_tpl(load_tpl('layout_search.html')), {'title': 'Search'}), options)
+    else:
+        remove_output(output_dir / 'search.html')
+        remove_output(output_dir / LIBRARY_INDEX_NAME)
+    if not options.compress:
+        # Precompressed copies from an earlier --compress build would otherwise be served.
+        for name in ('index.html', SW_NAME, 'search.html', LIBRARY_INDEX_NAME):
+            for ext in ('.gz', '.br'):
+                (output_dir / (name + ext)).unlink(missing_ok=True)
+
+
+def count_pages(raw: bytes, limit: int, options: BuildOptions) -> Paginator:
+    pager = Paginator(limit)
+    SANITIZERS['lxml'](raw, pager.write, None, pager, options.minify)
+    return pager
+
+
+def plan_ebook(archive: EpubArchive, options: BuildOptions = BuildOptions()) -> Tuple[str, List[Chapter], str]:
+    title = get_epub_title(archive, fallback=archive.path.stem)
+
+    sorted_items = sorted(archive.documents(), key=lambda x: natural_sort_key(os.path.basename(x.href)))
+
+    out_names = [f"{i+1}.html" for i in range(len(sorted_items))]
+    filenames_map = {os.path.basename(item.href): i for i, item in enumerate(sorted_items)}
+    sizes = [archive.size(item.href) for item in sorted_items]
+
+    # Oversized chapters are sanitized once up front to learn their page count and which
+    # page each anchor lands on, so neighbours and the TOC can link to the right page.
+    pages = [1] * len(sorted_items)
+    anchors: List[Dict[str, int]] = [{} for _ in sorted_items]
+    for i, item in enumerate(sorted_items):
+        if not options.page_chars or sizes[i] <= options.page_chars:
+            continue
+        raw = archive.read(item.href)
+        limit = page_limit(raw, options)
+        if limit:
+            pager = count_pages(raw, limit, options)
+            pages[i] = pager.page + 1
+            anchors[i] = pager.anchors
+
+    chapters = [
+        (out_names[i], page_name(out_names[i-1], pages[i-1] - 1) if i > 0 else None,
+         out_names[i+1] if i < len(out_names)-1 else None, item.href, sizes[i], pages[i])
+        for i, item in enumerate(sorted_items)
+    ]
 
     toc_list = []
     def walk_toc(it):
         toc_list.append('<ul>')
-        for i in it:
-            link, child = (i, []) if isinstance(i, epub.Link) else i
+        for link_title, href, child in it:
             try:
-                target = book.get_item_with_href(urldefrag(link.href).url)
-                if target and target.get_type() == ebooklib.ITEM_DOCUMENT:
-                    t_orig = os.path.basename(target.get_name())
+                url, fragment = urldefrag(href)
+                target = archive.item_with_href(unquote(url))
+                if target and target.is_document:
+                    t_orig = os.path.basename(target.href)
                     if t_orig in filenames_map:
-                        toc_list.append(f'<li><a href="chapters/{filenames_map[t_orig]}">{link.title}</a>')
+                        i = filenames_map[t_orig]
+                        link = out_names[i]
+                        if pages[i] > 1 and fragment:
+                            link = f"{page_name(link, anchors[i].get(fragment, 0))}#{fragment}"
+                        toc_list.append(f'<li><a href="chapters/{link}">{link_title}</a>')
                         if child: walk_toc(child)
                         toc_list.append('</li>')
             except Exception as e:
-                logger.warning(f"Failed to process TOC link {link.href}: {e}")
+                logger.warning(f"Failed to process TOC link {href}: {e}")
         toc_list.append('</ul>')
 
-    walk_toc(book.toc)
-    out_toc = book_root / 'index.html'
-    final_toc = load_tpl('layout_toc.html').replace('{title}', title).replace('{toc_content}', "".join(toc_list)).replace('../index.html', '../../index.html')
-    with open(out_toc, 'w', encoding='utf-8') as f:
-        f.write(final_toc)
-    return title
+    walk_toc(archive.toc)
+    return title, chapters, "".join(toc_list)
+
 
-def process_epub_file(args: Tuple[Path, Path]) -> Optional[Dict[str, str]]:
-    epub_path, books_dir = args
-    folder = epub_path.stem
+def read_chapters(archive: EpubArchive, chapters: Iterable[Chapter], timer: StageTimer) -> Iterator[Tuple[Chapter, bytes]]:
+    for chapter in chapters:
+        with timer.stage('read', chapter[4]):
+            raw = archive.read(chapter[3])
+        yield chapter, raw
+
+
+def open_store(chapters_dir: Path, options: BuildOptions) -> Optional[ChapterStore]:
+    if not options.dedup:
+        return None
+    # chapters_dir is <output>/books/<book>/chapters; the store is shared by the whole shelf.
+    return ChapterStore(chapters_dir.parents[2] / STORE_DIR, f'{CONVERTER_VERSION}:{int(options.minify)}')
+
+
+def chapter_keys(args: Tuple[Path, Path, BuildOptions]) -> Optional[List[str]]:
+    # Store keys of the chapters --dedup may share, i.e. those that are not paginated,
+    # so the shelf knows which bodies occur more than once before any book is rendered.
+    epub_path, books_dir, options = args
+    store = open_store(books_dir / epub_path.stem / 'chapters', options)
     try:
-        title = convert_ebook(epub_path, books_dir / folder)
-        return {'title': title, 'path': f"books/{folder}/index.html"}
+        with EpubArchive(epub_path) as archive:
+            raws = (archive.read(item.href) for item in archive.documents())
+            return [store.key(raw) for raw in raws if not page_limit(raw, options)]
+    except Exception as e:
+        logger.error(f"Failed to read {epub_path.name}: {e}")
+        return None
+
+
+def render_stored(chapters_dir: Path, tpl_chapter: List[str], tpl_loader: List[str], title: str,
+                  chapter: Chapter, raw: bytes, key: str, options: BuildOptions, index: Optional[BookIndex],
+                  store: ChapterStore, spans: Optional[Dict] = None,
+                  tpl_offline: Optional[List[str]] = None) -> None:
+    hit, counts = store.lookup(key, index is not None)
+    if not hit:
+        sanitize = SANITIZERS[options.sanitizer]
+
+        def render(write):
+            tokenizer = ChapterTokenizer() if index is not None else None
+            sanitize(raw, write, tokenizer.feed if tokenizer else None, None, options.minify)
+            return tokenizer.close() if tokenizer else None
+
+        counts = store.add(key, render)
+        if options.compress:
+            precompress(store.path(key))
+    store.record(key, hit)
+
+    # The page itself only carries the book-specific title and navigation.
+    writer = PageWriter(chapters_dir, tpl_chapter, title, chapter, 0, None, options.compress, None, tpl_offline)
+    writer.write(''.join(render_tpl(tpl_loader, {'src': '../../../' + store.href(key)})))
+    writer.close()
+    if spans is not None:
+        spans[chapter[0]] = key
+    if index is not None:
+        index.add(chapter[0], counts)
+
+
+def render_chapters(chapters_dir: Path, title: str, chapters: Iterable[Tuple[Chapter, bytes]],
+                    options: BuildOptions = BuildOptions(), index: Optional[BookIndex] = None,
+                    timer: Optional[StageTimer] = None, store: Optional[ChapterStore] = None,
+                    spans: Optional[Dict] = None, shared: AbstractSet[str] = frozenset()) -> None:
+    # With a store, chapters whose body occurs more than once on the shelf (shared) are
+    # stored once and loaded by a stub page; every other chapter is written inline.
+    timer = timer or StageTimer()
+    sanitize = SANITIZERS[options.sanitizer]
+    tpl_chapter = layout_tpl('layout_chapter.html', options)
+    tpl_loader = layout_tpl('fragment_store_loader.html', options) if store is not None else None
+    tpl_offline = layout_tpl('fragment_offline.html', options) if options.offline else None
+    for chapter, raw in chapters:
+        # The sanitized body goes straight to the page files instead of being built up in memory.
+        with timer.stage('render', len(raw)):
+            limit = page_limit(raw, options)
+            key = store.key(raw) if store is not None and not limit else None
+            if key in shared:
+                render_stored(chapters_dir, tpl_chapter, tpl_loader, title, chapter, raw, key, options, index, store,
+                              spans, tpl_offline)
+                continue
+            writer = PageWriter(chapters_dir, tpl_chapter, title, chapter, limit, index, options.compress, spans,
+                                tpl_offline)
+            try:
+                sanitize(raw, writer.write, writer.on_text if index is not None else None,
+                         writer if limit else None, options.minify)
+            finally:
+                writer.close()
+
+
+def write_toc(book_root: Path, title: str, toc_content: str, options: BuildOptions = BuildOptions()) -> None:
+    tpl = load_tpl('layout_toc.html').replace('../index.html', '../../index.html')
+    tpl_toc = layout_tpl('layout_toc.html', options, tpl)
+    tpl_offline = layout_tpl('fragment_offline.html', options) if options.offline else None
+    write_output(book_root / 'index.html', render_tpl(tpl_toc, {
+        'title': title, 'toc_content': toc_content, 'head': offline_head(tpl_offline, f'../../{SW_NAME}')}), options)
+
+
+def write_assets(book_root: Path, spans: Dict, options: BuildOptions) -> None:
+    # What the service worker needs to read the book offline, keyed by path relative to the
+    # book root, with a content hash per file. Store files are named by their content key
+    # already, so only the book's own pages are read back.
+    if not options.offline:
+        remove_output(book_root / ASSETS_NAME)
+        return
+    files = {'index.html': file_sha256(book_root / 'index.html')[:16]}
+    for name in sorted(spans, key=natural_sort_key):
+        files[f'chapters/{name}'] = file_sha256(book_root / 'chapters' / name)[:16]
+    for key in sorted({span for span in spans.values() if isinstance(span, str)}):
+        files['../../' + store_href(key)] = key[:16]
+    version = hashlib.sha256(json.dumps(files, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+    write_output(book_root / ASSETS_NAME, [json.dumps({'version': version, 'files': files}, separators=(',', ':'))],
+                 options)
+
+
+def split_batches(chapters: List[Chapter], batch_bytes: int) -> List[List[Chapter]]:
+    batches: List[List[Chapter]] = [[]]
+    size = 0
+    for chapter in chapters:
+        if size >= batch_bytes:
+            batches.append([])
+            size = 0
+        batches[-1].append(chapter)
+        size += chapter[4]
+    return batches
+
+
+def write_book_ir(book_root: Path, title: str, toc_content: str, chapters: List[Chapter], spans: Dict) -> None:
+    # Enough to re-apply templates later: the plan, the TOC markup and where each page's
+    # body sits inside the page (or its store key), so bodies are never stored twice.
+    ir = {'v': 1, 'title': title, 'toc': toc_content, 'chapters': chapters, 'spans': spans}
+    with open(book_root / BOOK_IR_NAME, 'w', encoding='utf-8') as f:
+        json.dump(ir, f, ensure_ascii=False, separators=(',', ':'), sort_keys=True)
+
+
+def prune_book(book_root: Path, spans: Dict, options: BuildOptions) -> None:
+    # Drops what an earlier build of the book wrote and this one did not: pages of chapters
+    # that are now shorter or gone, or files of options that are now off.
+    keep = {'index.html'} | {f'chapters/{name}' for name in spans}
+    if options.offline:
+        keep.add(ASSETS_NAME)
+    if options.search:
+        keep.add(SHARD_NAME)
+    if options.compress:
+        keep |= {name + ext for name in keep for ext in ('.gz', '.br')}
+    keep.add(BOOK_IR_NAME)
+    for path in list(book_root.rglob('*')):
+        if path.is_file() and path.relative_to(book_root).as_posix() not in keep:
+            path.unlink()
+
+
+def finish_book(book_root: Path, title: str, toc_content: str, index: Optional[BookIndex],
+                options: BuildOptions = BuildOptions(), chapters: Optional[List[Chapter]] = None,
+                spans: Optional[Dict] = None) -> None:
+    write_toc(book_root, title, toc_content, options)
+    write_assets(book_root, spans or {}, options)
+    if index is not None:
+        index.write(book_root / SHARD_NAME)
+        if options.compress:
+            precompress(book_root / SHARD_NAME)
+    if chapters is not None:
+        write_book_ir(book_root, title, toc_content, chapters, spans or {})
+    prune_book(book_root, spans or {}, options)
+
+
+def build_book(epub_path: Path, book_root: Path, options: BuildOptions, timer: StageTimer,
+               shared: AbstractSet[str] = frozenset()) -> Dict:
+    index = BookIndex() if options.search else None
+    with timer.stage('open', epub_path.stat().st_size):
+        archive = EpubArchive(epub_path)
+    with archive:
+        with timer.stage('plan'):
+            title, chapters, toc_content = plan_ebook(archive, options)
+        result = {'title': title, 'path': f"books/{book_root.name}/index.html",
+                  'author': get_epub_metadata(archive, 'creator'), 'language': get_epub_metadata(archive, 'language')}
+        chapters_dir = book_root / 'chapters'
+        chapters_dir.mkdir(parents=True, exist_ok=True)
+        if options.split_bytes and sum(c[4] for c in chapters) > options.split_bytes:
+            # Hand the plan back so the pool can render it as independent batches; each batch
+            # reads its own chapters from the EPUB, so no chapter passes through the parent.
+            return dict(result, toc=toc_content, chapters=chapters,
+                        batches=split_batches(chapters, options.split_bytes))
+        store = open_store(chapters_dir, options)
+        spans = {}
+        render_chapters(chapters_dir, title, read_chapters(archive, chapters, timer), options, index, timer,
+                        store, spans, shared)
+        if store is not None:
+            result['store'] = store.stats()
+    with timer.stage('finish'):
+        finish_book(book_root, title, toc_content, index, options, chapters, spans)
+    return result
+
+
+def convert_ebook(epub_path: Path, book_root: Path, options: BuildOptions = BuildOptions(),
+                  timer: Optional[StageTimer] = None) -> str:
+    return build_book(epub_path, book_root, options._replace(split_bytes=0), timer or StageTimer())['title']
+
+
+def process_epub_file(args: Tuple[Path, Path, BuildOptions, AbstractSet[str]]) -> Optional[Dict]:
+    epub_path, books_dir, options, shared = args
+    timer = StageTimer(epub_path.stem)
+    try:
+        result = build_book(epub_path, books_dir / epub_path.stem, options, timer, shared)
+        result['profile'] = timer.stages
+        return result
     except Exception as e:
         logger.error(f"Failed to convert {epub_path.name}: {e}")
         return None
 
 
+def process_chapter_batch(args: Tuple[Path, Path, str, List[Chapter], BuildOptions, AbstractSet[str]]
+                          ) -> Optional[Dict]:
+    epub_path, chapters_dir, title, chapters, options, shared = args
+    index = BookIndex() if options.search else None
+    timer = StageTimer()
+    store = open_store(chapters_dir, options)
+    spans = {}
+    try:
+        with timer.stage('open', epub_path.stat().st_size):
+            archive = EpubArchive(epub_path)
+        with archive:
+            render_chapters(chapters_dir, title, read_chapters(archive, chapters, timer), options, index, timer,
+                            store, spans, shared)
+        return {'index': index, 'profile': timer.stages, 'store': store.stats() if store else None,
+                'spans': spans}
+    except Exception as e:
+        logger.error(f"Failed to convert chapters {chapters[0][0]}-{chapters[-1][0]} of {title}: {e}")
+        return None
+
+
+def build_shelf(in_dir: Path, out_dir: Path, options: BuildOptions, scheduler: Optional[Scheduler] = None,
+                incremental: bool = False) -> Dict[str, StageTimer]:
+    scheduler = scheduler or Scheduler(jobs=1)
+    books_dir = out_dir / 'books'
+    books_dir.mkdir(parents=True, exist_ok=True)
+
+    epub_files = sorted(in_dir.glob('*.epub'))
+    old_manifest = load_manifest(out_dir)
+    tpl_hash = templates_hash()
+    # Options that change what is written for a book; the split size only changes scheduling.
+    output_options = {k: v for k, v in options._asdict().items() if k not in BUILD_ONLY_OPTIONS}
+    reusable = (
+        incremental
+        and old_manifest.get('version') == CONVERTER_VERSION
+        and old_manifest.get('templates') == tpl_hash
+        and all(old_manifest.get(k) == v for k, v in output_options.items())
+    )
+    manifest = {'version': CONVERTER_VERSION, 'templates': tpl_hash, **output_options, 'books': {}}
+
+    tasks = []
+    stats = {}
+    for p in epub_files:
+        st = p.stat()
+        stats[p.stem] = {'size': st.st_size, 'mtime': st.st_mtime_ns}
+        entry = old_manifest['books'].get(p.stem)
+        # Trust the recorded hash while size and mtime are unchanged, so polling stays cheap.
+        if entry and entry.get('size') == st.st_size and entry.get('mtime') == st.st_mtime_ns:
+            digest = entry['hash']
+        else:
+            digest = file_sha256(p)
+        if (reusable and entry and entry.get('hash') == digest
+                and (books_dir / p.stem / 'index.html').exists()):
+            manifest['books'][p.stem] = dict(entry, **stats[p.stem])
+        else:
+            tasks.append((p, books_dir, digest))
+
+    for folder in set(old_manifest['books']) - {p.stem for p in epub_files}:
+        logger.info(f"Pruning removed book: {folder}")
+        shutil.rmtree(books_dir / folder, ignore_errors=True)
+
+    # --dedup only stores bodies that occur more than once on the shelf, so every book's
+    # chapter keys are needed before any of them is rendered.
+    keys: Dict[str, List[str]] = {folder: b.get('keys', []) for folder, b in manifest['books'].items()}
+    shared: Dict[str, frozenset] = {}
+    if options.dedup:
+        def add_keys(task: Task, result: Optional[List[str]]) -> None:
+            keys[task.key] = result or []
+
+        scheduler.run([Task(chapter_keys, (p, books, options), p.stem, stats[p.stem]['size'])
+                       for p, books, _ in tasks], add_keys)
+        refs = Counter(key for book in keys.values() for key in book)
+        shared = {folder: frozenset(key for key in book if refs[key] > 1) for folder, book in keys.items()}
+        # A kept book is converted again when a copy of one of its chapters was added to or
+        # removed from the shelf, so its pages stub exactly the bodies that are shared.
+        paths = {p.stem: p for p in epub_files}
+        for folder, entry in list(manifest['books'].items()):
+            if shared[folder] != set(entry.get('store', [])):
+                del manifest['books'][folder]
+                tasks.append((paths[folder], books_dir, entry['hash']))
+
+    logger.info(f"Processing {len(tasks)} EPUB file(s), {len(manifest['books'])} unchanged...")
+
+    timers: Dict[str, StageTimer] = {}
+
+    reused = [0, 0]
+
+    def record(result: Optional[Dict], digest: str) -> None:
+        if result:
+            folder = Path(result['path']).parent.name
+            manifest['books'][folder] = {'title': result['title'], 'path': result['path'], 'hash': digest,
+                                         'author': result['author'], 'language': result['language'],
+                                         **stats[folder]}
+            if result.get('store'):
+                manifest['books'][folder]['store'] = result['store']['keys']
+                manifest['books'][folder]['keys'] = keys[folder]
+                reused[0] += result['store']['hits']
+                reused[1] += result['store']['hits'] + result['store']['misses']
+            logger.info(f"Converted: {result['title']}")
+
+    def profile(result: Optional[Dict], folder: Optional[str] = None) -> None:
+        if result:
+            folder = folder or Path(result['path']).parent.name
+            timers.setdefault(folder, StageTimer(folder)).merge(result['profile'])
+
+    split_books: Dict[str, Dict] = {}
+
+    def handle(task: Task, result: Optional[Dict]) -> Optional[List[Task]]:
+        if task.key in split_books:
+            book = split_books[task.key]
+            folder = Path(book['path']).parent.name
+            profile(result, folder)
+            book['remaining'] -= 1
+            book['ok'] = book['ok'] and result is not None
+            if result:
+                # Batches finish in any order; their indexes are merged in chapter order.
+                batch = task.args[3]
+                book['indexes'][book['batches'][batch[0][0]]] = result['index']
+                book['store'] = merge_stats(book.get('store'), result['store'])
+                book['spans'].update(result['spans'])
+            if book['remaining'] == 0:
+                del split_books[task.key]
+                if book['ok']:
+                    if options.search:
+                        for index in book['indexes']:
+                            book['index'].merge(index)
+                    with timers[folder].stage('finish'):
+                        finish_book(books_dir / folder, book['title'], book['toc'], book['index'],
+                                    options, book['chapters'], book['spans'])
+                    record(book, book['digest'])
+        elif result and 'batches' in result:
+            profile(result)
+            batches = result.pop('batches')
+            chapters_dir = out_dir / Path(result['path']).parent / 'chapters'
+            logger.info(f"Splitting {result['title']} into {len(batches)} chapter batches")
+            split_books[result['path']] = dict(result, digest=task.key, remaining=len(batches), ok=True,
+                                               index=BookIndex() if options.search else None, spans={},
+                                               batches={batch[0][0]: i for i, batch in enumerate(batches)},
+                                               indexes=[None] * len(batches))
+            epub_path = task.args[0]
+            return [Task(process_chapter_batch, (epub_path, chapters_dir, result['title'], batch, options,
+                                                 shared.get(epub_path.stem, frozenset())),
+                         result['path'], sum(c[4] for c in batch))
+                    for batch in batches]
+        else:
+            profile(result)
+            record(result, task.key)
+        return None
+
+    scheduler.run(
+        [Task(process_epub_file, (p, books, options, shared.get(p.stem, frozenset())), digest, stats[p.stem]['size'])
+         for p, books, digest in tasks],
+        handle)
+
+    save_manifest(out_dir, manifest)
+    if options.dedup:
+        stored = (key for b in manifest['books'].values() for key in b.get('store', []))
+        removed = prune_store(out_dir / STORE_DIR, stored)
+        report = write_dedup_report(out_dir, {folder: b.get('keys', []) for folder, b in manifest['books'].items()})
+        logger.info(f"Dedup: {reused[0]} of {reused[1]} stored chapter(s) reused from the store, "
+                    f"{report['unique']} unique of {report['chapters']} on the shelf, {report['stored']} stored, "
+                    f"{report['saved_bytes'] // 1024}KB saved, {removed} stale file(s) pruned")
+    elif (out_dir / STORE_DIR).exists():
+        logger.info("Removing chapter store left by an earlier --dedup build")
+        shutil.rmtree(out_dir / STORE_DIR, ignore_errors=True)
+        (out_dir / REPORT_NAME).unlink(missing_ok=True)
+    create_master_index(out_dir, shelf_records(manifest), options)
+    logger.info(f"Done! Created bookshelf at {out_dir / 'index.html'}")
+    return timers
+
+
+def rerender_book(args: Tuple[Path, BuildOptions]) -> Optional[str]:
+    # Re-applies the current templates to a built book using its .book.json: each page's
+    # body is sliced out of the page already on disk, so no EPUB is opened or sanitized.
+    book_root, options = args
+    try:
+        with open(book_root / BOOK_IR_NAME, 'r', encoding='utf-8') as f:
+            ir = json.load(f)
+        title = ir['title']
+        chapters_dir = book_root / 'chapters'
+        tpl_chapter = layout_tpl('layout_chapter.html', options)
+        tpl_loader = layout_tpl('fragment_store_loader.html', options) if options.dedup else None
+        tpl_offline = layout_tpl('fragment_offline.html', options) if options.offline else None
+        spans = {}
+        for chapter in map(tuple, ir['chapters']):
+            for page in range(chapter[5]):
+                name = page_name(chapter[0], page)
+                span = ir['spans'][name]
+                if isinstance(span, str):
+                    body = ''.join(render_tpl(tpl_loader, {'src': '../../../' + store_href(span)}))
+                else:
+                    with open(chapters_dir / name, 'r', encoding='utf-8') as f:
+                        body = f.read()[span[0]:span[1]]
+                head, tail = page_frame(tpl_chapter, title, page_nav(chapter, page),
+                                        page_head(tpl_offline, chapter, page))
+                write_output(chapters_dir / name, head + [body] + tail, options)
+                start = sum(map(len, head))
+                spans[name] = span if isinstance(span, str) else [start, start + len(body)]
+        write_toc(book_root, title, ir['toc'], options)
+        write_assets(book_root, spans, options)
+        write_book_ir(book_root, title, ir['toc'], ir['chapters'], spans)
+        return title
+    except Exception as e:
+        logger.error(f"Failed to re-render {book_root.name}: {e}")
+        return None
+
+
+def rerender_shelf(out_dir: Path, options: BuildOptions, scheduler: Optional[Scheduler] = None) -> bool:
+    manifest = load_manifest(out_dir)
+    fields = [k for k in BuildOptions._fields if k not in BUILD_ONLY_OPTIONS]
+    if manifest.get('version') != CONVERTER_VERSION or any(k not in manifest for k in fields):
+        logger.error(f"{out_dir} was not built by this converter version; run a full build")
+        return False
+    # Rendered with the options the shelf was built with, so the output matches a full rebuild.
+    options = options._replace(**{k: manifest[k] for k in fields})
+    books_dir = out_dir / 'books'
+    folders = sorted(manifest['books'])
+    missing = [f for f in folders if not (books_dir / f / BOOK_IR_NAME).exists()]
+    if missing:
+        logger.error(f"No saved book data for {len(missing)} book(s) (e.g. {missing[0]}); run a full build")
+        return False
+
+    results = []
+    (scheduler or Scheduler(jobs=1)).run(
+        [Task(rerender_book, (books_dir / folder, options), folder, manifest['books'][folder].get('size', 0))
+         for folder in folders],
+        lambda task, result: results.append(result))
+    if not all(results):
+        logger.error("Some books failed to re-render; run a full build")
+        return False
+
+    manifest['templates'] = templates_hash()
+    save_manifest(out_dir, manifest)
+    create_master_index(out_dir, shelf_records(manifest), options)
+    logger.info(f"Re-rendered {len(folders)} book(s) at {out_dir / 'index.html'}")
+    return True
+
+
+def snapshot(in_dir: Path) -> Dict[str, Tuple[int, int]]:
+    paths = list(in_dir.glob('*.epub')) + template_files()
+    result = {}
+    for p in paths:
+        try:
+            st = p.stat()
+        except FileNotFoundError:
+            continue
+        result[str(p)] = (st.st_size, st.st_mtime_ns)
+    return result
+
+
+def wait_for_changes(in_dir: Path, interval: float) -> None:
+    # Blocks on inotify when inotify_simple is installed, otherwise just sleeps; the caller
+    # compares snapshots either way, so a missed or spurious event only costs one poll.
+    try:
+        from inotify_simple import INotify, flags
+    except ImportError:
+        time.sleep(interval)
+        return
+    with INotify() as inotify:
+        mask = flags.CLOSE_WRITE | flags.MOVED_TO | flags.MOVED_FROM | flags.CREATE | flags.DELETE
+        for d in (in_dir, BASE_TPL_DIR):
+            inotify.add_watch(str(d), mask)
+        inotify.read(timeout=int(interval * 1000))
+
+
+def watch(in_dir: Path, out_dir: Path, options: BuildOptions, scheduler: Scheduler, interval: float) -> None:
+    # The scheduler keeps one pool for the whole session, so workers stay warm with lxml
+    # and friends imported.
+    try:
+        seen = snapshot(in_dir)
+        build_shelf(in_dir, out_dir, options, scheduler, incremental=True)
+        logger.info(f"Watching {in_dir} and {BASE_TPL_DIR} for changes (Ctrl+C to stop)")
+        while True:
+            wait_for_changes(in_dir, interval)
+            current = snapshot(in_dir)
+            if current == seen:
+                continue
+            # Let a writer finish before converting a half-written file.
+            time.sleep(min(interval, 0.2))
+            current = snapshot(in_dir)
+            started = time.perf_counter()
+            changed = {k for k in seen.keys() | current.keys() if seen.get(k) != current.get(k)}
+            # Template edits alone only need the pages re-wrapped, not the books re-parsed.
+            if not (all(Path(k).parent == BASE_TPL_DIR for k in changed)
+                    and rerender_shelf(out_dir, options, scheduler)):
+                build_shelf(in_dir, out_dir, options, scheduler, incremental=True)
+            logger.info(f"Rebuilt in {time.perf_counter() - started:.2f}s")
+            seen = current
+    except KeyboardInterrupt:
+        logger.info("Stopped watching")
+
+
 def main() -> None:
     parser = argparse.ArgumentParser(description='Convert EPUB files to HTML bookshelf')
     parser.add_argument('-i', '--input', required=True, help='Input directory containing EPUB files')
     parser.add_argument('-o', '--output', required=True, help='Output directory for HTML files')
-    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of parallel jobs (default: 1)')
+    add_scheduler_args(parser)
+    parser.add_argument('--split-size', type=float, default=4,
+                        help='Split books with more than this many MB of chapters into parallel batches (default: 4)')
+    parser.add_argument('--sanitizer', choices=sorted(SANITIZERS), default='lxml',
+                        help='Chapter sanitizer engine (default: lxml)')
+    parser.add_argument('--incremental', action='store_true', help='Skip books unchanged since the last build')
+    parser.add_argument('--watch', action='store_true',
+                        help='Keep running and rebuild changed books when the input or templates change')
+    parser.add_argument('--interval', type=float, default=1.0,
+                        help='Polling interval in seconds for --watch (default: 1)')
+    parser.add_argument('--rerender', action='store_true',
+                        help='Re-apply changed templates to an existing output without re-parsing any EPUB')
+    parser.add_argument('--search', action='store_true',
+                        help='Build a full-text search index and search page (tokenizes every chapter)')
+    parser.add_argument('--page-chars', type=int, default=0,
+                        help='Split chapters longer than this many characters into pages (default: 0, off)')
+    parser.add_argument('--minify', action='store_true', help='Collapse whitespace and drop comments in output HTML')
+    parser.add_argument('--compress', action='store_true',
+                        help='Write .gz (and .br if brotli is installed) siblings next to output files')
+    parser.add_argument('--dedup', action='store_true',
+                        help='Store chapter bodies that occur more than once on the shelf in a shared store')
+    parser.add_argument('--offline', action='store_true',
+                        help='Add a service worker that prefetches the next chapter and keeps read books offline')
+    parser.add_argument('--group-by', choices=['author', 'language'],
+                        help='Group books on the shelf page by author or language')
+    parser.add_argument('--profile', metavar='PATH',
+                        help='Write per-book, per-stage timings to PATH (.json or .csv)')
     parser.add_argument('-v', '--verbose', action='store_true', help='Enable verbose logging')
     args = parser.parse_args()
+    if (args.page_chars or args.minify) and args.sanitizer != 'lxml':
+        parser.error('--page-chars and --minify require the lxml sanitizer')
+    started = time.perf_counter()
 
     logging.basicConfig(
         level=logging.DEBUG if args.verbose else logging.INFO,
@@ -128,38 +888,39 @@ def main() -> None:
         logger.error(f"Input directory does not exist: {in_dir}")
         sys.exit(1)
 
-    books_dir = out_dir / 'books'
-    books_dir.mkdir(parents=True, exist_ok=True)
+    scheduler = scheduler_from_args(args, 'book')
+    options = BuildOptions(
+        sanitizer=args.sanitizer,
+        split_bytes=int(args.split_size * 1024 * 1024) if scheduler.jobs > 1 else 0,
+        search=args.search,
+        page_chars=args.page_chars,
+        minify=args.minify,
+        compress=args.compress,
+        dedup=args.dedup,
+        group_by=args.group_by or '',
+        offline=args.offline,
+    )
 
-    epub_files = sorted(in_dir.glob('*.epub'))
-    if not epub_files:
-        logger.warning(f"No EPUB files found in {in_dir}")
-        return
+    with scheduler:
+        if args.rerender:
+            if not rerender_shelf(out_dir, options, scheduler):
+                sys.exit(1)
+            return
 
-    logger.info(f"Processing {len(epub_files)} EPUB file(s)...")
+        if args.watch:
+            watch(in_dir, out_dir, options, scheduler, args.interval)
+            return
 
-    data: List[Dict[str, str]] = []
-    tasks = [(p, books_dir) for p in epub_files]
+        if not any(in_dir.glob('*.epub')):
+            logger.warning(f"No EPUB files found in {in_dir}")
+            return
 
-    if len(tasks) == 1 or args.jobs == 1:
-        for task in tasks:
-            result = process_epub_file(task)
-            if result:
-                data.append(result)
-                logger.info(f"Converted: {result['title']}")
-    else:
-        max_workers = min(args.jobs, len(tasks))
-        with ProcessPoolExecutor(max_workers=max_workers) as executor:
-            futures = {executor.submit(process_epub_file, task): task for task in tasks}
-            for future in as_completed(futures):
-                result = future.result()
-                if result:
-                    data.append(result)
-                    logger.info(f"Converted: {result['title']}")
-
-    create_master_index(out_dir, data)
-    logger.info(f"Done! Created bookshelf at {out_dir / 'index.html'}")
+        timers = build_shelf(in_dir, out_dir, options, scheduler, args.incremental)
+
+    if args.profile:
+        write_report(Path(args.profile), list(timers.values()), time.perf_counter() - started)
+        logger.info(f"Wrote profile to {args.profile}")
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -1,79 +1,141 @@
+import os
 import sys
 import json
 import argparse
 import logging
+import posixpath
 from pathlib import Path
-from typing import List
-import warnings
-from bs4 import BeautifulSoup, XMLParsedAsHTMLWarning
-from ebooklib import epub, ITEM_DOCUMENT, ITEM_IMAGE, ITEM_STYLE, ITEM_FONT
+from typing import Dict, List, Optional, Set, Tuple
+from urllib.parse import unquote, urlsplit
 
-warnings.filterwarnings('ignore', category=XMLParsedAsHTMLWarning)
-
-from utils import read_epub_safe, get_epub_title, setup_logger
+from utils import DocumentLoader, EpubArchive, get_epub_title, setup_logger, file_sha256
+from catalog import iter_toc
 
 logger = logging.getLogger(__name__)
 
+CHECK_VERSION = 4
+DEFAULT_CACHE = '.epub_check_cache.json'
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.gif', '.tiff', '.tif', '.png')
+FONT_EXTENSIONS = ('.otf', '.woff', '.ttf')
+LINK_SAMPLES = 8
+
+
+def resolve_link(base: str, link: str) -> Optional[Tuple[str, str]]:
+    # (manifest href, fragment) for a link found in the document at base; None if external.
+    parts = urlsplit(link)
+    if parts.scheme or parts.netloc:
+        return None
+    path = unquote(parts.path)
+    target = posixpath.normpath(posixpath.join(posixpath.dirname(base), path)) if path else base
+    return target, unquote(parts.fragment)
+
 
-def scan_headings(book: epub.EpubBook):
+def scan_documents(archive: EpubArchive):
+    # One parse per document feeds both the heading counts and the link index: the ids
+    # each document defines, ids defined twice, and every <a>/<area> href it contains.
+    from lxml import etree
+    text_xpath = etree.XPath('.//text()')
     h1, h2, h3 = [], [], []
-    for item in book.get_items():
-        if item.get_type() != ITEM_DOCUMENT:
-            continue
+    ids: Dict[str, Set[str]] = {}
+    duplicates: List[str] = []
+    links: List[Tuple[str, str]] = []
+    loader = DocumentLoader()
+    for item in archive.documents():
         try:
-            soup = BeautifulSoup(item.get_content().decode('utf-8', 'ignore'), 'lxml')
-            for tag in soup.find_all(['h1', 'h2', 'h3']):
-                text = tag.get_text(strip=True)
-                if not text:
-                    continue
-                if tag.name == 'h1':
-                    h1.append(text)
-                elif tag.name == 'h2':
-                    h2.append(text)
-                else:
-                    h3.append(text)
+            root = loader.parse(archive.read(item.href))
+            if root is None:
+                continue
+            seen = ids[item.href] = set()
+            for el in root.iter(etree.Element):
+                name = el.tag.rpartition('}')[2]
+                el_id = el.get('id')
+                if el_id is not None:
+                    if el_id in seen:
+                        duplicates.append(f'{item.href}#{el_id}')
+                    seen.add(el_id)
+                if name in ('a', 'area'):
+                    if el.get('name'):
+                        seen.add(el.get('name'))
+                    if el.get('href'):
+                        links.append((item.href, el.get('href').strip()))
+                elif name in ('h1', 'h2', 'h3'):
+                    text = ''.join(s.strip() for s in text_xpath(el))
+                    if not text:
+                        continue
+                    if name == 'h1':
+                        h1.append(text)
+                    elif name == 'h2':
+                        h2.append(text)
+                    else:
+                        h3.append(text)
         except Exception:
             pass
-    return h1, h2, h3
+    return (h1, h2, h3), ids, duplicates, links
+
+
+def check_links(archive: EpubArchive, ids: Dict[str, Set[str]], links: List[Tuple[str, str]]):
+    # Every lookup is a dict or set probe, so the pass is linear in the number of links.
+    dangling = []
+    reached = set()
+
+    def check(source: str, base: str, link: str) -> None:
+        resolved = resolve_link(base, link)
+        if resolved is None:
+            return
+        target, fragment = resolved
+        if target not in archive.by_href:
+            dangling.append(f'{source}: {link} (no such item)')
+            return
+        reached.add(target)
+        # Documents that failed to parse have no id set and are not second-guessed.
+        if fragment and target in ids and fragment not in ids[target]:
+            dangling.append(f'{source}: {link} (no such id)')
+
+    for (_, href, _), _ in iter_toc(archive.toc):
+        if href:
+            check('TOC', '', href)
+    for base, link in links:
+        check(base, base, link)
+
+    # The same broken link repeated across a chapter is reported once.
+    dangling = list(dict.fromkeys(dangling))
+    names = set(archive.zf.namelist())
+    missing = sorted(item.href for item in archive.manifest.values() if archive.zip_name(item.href) not in names)
+    orphans = [f'spine idref {idref!r} (not in manifest)' for idref in archive.spine if idref not in archive.manifest]
+    in_spine = {archive.manifest[idref].href for idref in archive.spine if idref in archive.manifest}
+    orphans.extend(
+        f'{item.href} (not in spine, never linked)' for item in archive.documents()
+        if item.href not in in_spine and item.href not in reached and 'nav' not in item.properties)
+    return dangling, missing, orphans
 
 
 def scan_epub(epub_path: Path):
-    book = read_epub_safe(epub_path)
-
-    meta = {}
-    for field in ('title', 'creator', 'language', 'date', 'publisher', 'identifier'):
-        vals = book.get_metadata('DC', field)
-        if vals:
-            meta[field] = vals[0][0]
-
-    toc = []
-    def walk(items, depth=0):
-        for item in items:
-            if isinstance(item, tuple) and len(item) >= 1:
-                link = item[0]
-                if isinstance(link, epub.Link):
-                    toc.append({'title': link.title, 'depth': depth})
-                if len(item) > 1 and isinstance(item[1], list):
-                    walk(item[1], depth + 1)
-            elif isinstance(item, epub.Link):
-                toc.append({'title': item.title, 'depth': depth})
-
-    walk(book.toc)
-
-    docs = imgs = styles = fonts = 0
-    for item in book.get_items():
-        t = item.get_type()
-        if t == ITEM_DOCUMENT:
-            docs += 1
-        elif t == ITEM_IMAGE:
-            imgs += 1
-        elif t == ITEM_STYLE:
-            styles += 1
-        elif t == ITEM_FONT:
-            fonts += 1
-
-    h1, h2, h3 = scan_headings(book)
-    spine_count = len(list(book.spine))
+    with EpubArchive(epub_path) as archive:
+        meta = {}
+        for field in ('title', 'creator', 'language', 'date', 'publisher', 'identifier'):
+            vals = archive.get_metadata('DC', field)
+            if vals:
+                meta[field] = vals[0][0]
+
+        # Entries with children are sections, which are not counted themselves. Kept as
+        # (title, depth) pairs, which the cache stores as lists; --json spells them out.
+        toc = [(title, depth) for (title, _, children), depth in iter_toc(archive.toc) if not children]
+
+        docs = imgs = styles = fonts = 0
+        for item in archive.manifest.values():
+            ext = posixpath.splitext(item.href)[1].lower()
+            if item.is_document:
+                docs += 1
+            elif item.media_type.startswith('image/') or ext in IMAGE_EXTENSIONS:
+                imgs += 1
+            elif ext == '.css':
+                styles += 1
+            elif ext in FONT_EXTENSIONS:
+                fonts += 1
+
+        (h1, h2, h3), ids, duplicates, links = scan_documents(archive)
+        dangling, missing, orphans = check_links(archive, ids, links)
+        spine_count = len(archive.spine)
 
     issues = []
     if not meta.get('creator'):
@@ -82,6 +144,14 @@ def scan_epub(epub_path: Path):
         issues.append('missing language')
     if docs == 0:
         issues.append('no document items')
+    if missing:
+        issues.append(f'{len(missing)} missing file(s)')
+    if dangling:
+        issues.append(f'{len(dangling)} dangling link(s)')
+    if duplicates:
+        issues.append(f'{len(duplicates)} duplicate id(s)')
+    if orphans:
+        issues.append(f'{len(orphans)} orphaned item(s)')
 
     return {
         'file': epub_path.name,
@@ -97,10 +167,69 @@ def scan_epub(epub_path: Path):
         'h2': len(h2),
         'h3': len(h3),
         'h1_samples': h1[:8],
+        'links': len(links),
+        'problems': {
+            'missing': missing[:LINK_SAMPLES],
+            'dangling': dangling[:LINK_SAMPLES],
+            'duplicate_ids': duplicates[:LINK_SAMPLES],
+            'orphans': orphans[:LINK_SAMPLES],
+        },
         'issues': issues,
     }
 
 
+def check_file(epub_path: Path) -> Tuple[Optional[Dict], Optional[str]]:
+    try:
+        return scan_epub(epub_path), None
+    except Exception as e:
+        return None, str(e)
+
+
+def load_cache(path: Path) -> Dict[str, Dict]:
+    # results maps a content key to its scan result; files maps each checked path to its
+    # size, mtime and content key, so unchanged files are not hashed again.
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            cache = json.load(f)
+        if cache.get('version') == CHECK_VERSION:
+            return {'results': cache['results'], 'files': cache.get('files', {})}
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.warning(f'Ignoring unreadable cache {path}: {e}')
+    return {'results': {}, 'files': {}}
+
+
+def save_cache(path: Path, cache: Dict[str, Dict]) -> None:
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'version': CHECK_VERSION, **cache}, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def cache_key(fp: Path, files: Dict[str, Dict]) -> Tuple[str, Dict]:
+    # Trust the recorded key while size and mtime are unchanged; hash the file otherwise.
+    st = fp.stat()
+    entry = files.get(str(fp))
+    if entry and entry.get('size') == st.st_size and entry.get('mtime') == st.st_mtime_ns:
+        return entry['key'], entry
+    key = f'{file_sha256(fp)}:{st.st_size}'
+    return key, {'size': st.st_size, 'mtime': st.st_mtime_ns, 'key': key}
+
+
+def is_unchanged(path: str, entry: Dict) -> bool:
+    # Whether a file checked by an earlier run still exists with the recorded size and mtime.
+    try:
+        st = os.stat(path)
+    except OSError:
+        return False
+    return entry.get('size') == st.st_size and entry.get('mtime') == st.st_mtime_ns
+
+
+def json_result(r: Dict) -> Dict:
+    return dict(r, toc=[{'title': title, 'depth': depth} for title, depth in r['toc']])
+
+
 def print_result(r):
     size_kb = r['size'] // 1024
     m = r['meta']
@@ -113,13 +242,13 @@ def print_result(r):
         print(f"  Date:     {m['date']}")
 
     toc = r['toc']
-    max_depth = max((e['depth'] for e in toc), default=0)
+    max_depth = max((depth for _, depth in toc), default=0)
     print(f"  TOC:      {len(toc)} entries, max depth {max_depth}")
     if toc:
         print(f"  TOC preview:")
-        for e in toc[:10]:
-            indent = "  " * e['depth']
-            print(f"    {indent}- {e['title'][:80]}")
+        for title, depth in toc[:10]:
+            indent = "  " * depth
+            print(f"    {indent}- {title[:80]}")
 
     print(f"  Spine:    {r['spine']} items")
     print(f"  Content:  {r['docs']} docs | {r['images']} images | {r['styles']} styles | {r['fonts']} fonts")
@@ -129,8 +258,13 @@ def print_result(r):
         for h in r['h1_samples']:
             print(f"    - {h[:100]}")
 
+    print(f"  Links:    {r['links']} in text")
+
     if r['issues']:
         print(f"  Issues: {', '.join(r['issues'])}")
+        for kind, samples in r['problems'].items():
+            for sample in samples:
+                print(f"    {kind}: {sample[:120]}")
     else:
         print(f"  Clean.")
 
@@ -139,6 +273,10 @@ def main():
     parser = argparse.ArgumentParser(description='Scan EPUB files for structure and issues')
     parser.add_argument('path', nargs='+', help='EPUB file(s) or directory')
     parser.add_argument('--json', action='store_true', help='Output as JSON')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of parallel jobs (default: 1)')
+    parser.add_argument('--cache', default=DEFAULT_CACHE, help=f'Result cache file (default: {DEFAULT_CACHE})')
+    parser.add_argument('--no-cache', action='store_true', help='Do not read or write the result cache')
+    parser.add_argument('--strict', action='store_true', help='Exit with status 1 if any file has issues or fails to scan')
     parser.add_argument('-v', '--verbose', action='store_true', help='Verbose logging')
     args = parser.parse_args()
 
@@ -156,25 +294,68 @@ def main():
         print('No EPUB files found.')
         sys.exit(0)
 
+    cache_path = Path(args.cache)
+    if args.no_cache:
+        old_cache = {'results': {}, 'files': {}}
+        keys: List[Optional[str]] = [None] * len(files)
+    else:
+        old_cache = load_cache(cache_path)
+        stats = {str(fp): cache_key(fp, old_cache['files']) for fp in files}
+        keys = [stats[str(fp)][0] for fp in files]
+    cache = dict(old_cache['results'])
+    misses = [fp for fp, key in zip(files, keys) if key not in cache]
+    logger.debug(f'{len(files) - len(misses)} cached, {len(misses)} to scan')
+
+    executor = None
+    if args.jobs > 1 and len(misses) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        executor = ProcessPoolExecutor(max_workers=args.jobs)
+    scanned = iter(executor.map(check_file, misses) if executor else map(check_file, misses))
+
     results = []
-    issues_total = 0
-    for fp in files:
-        try:
-            r = scan_epub(fp)
+    issues_total = errors = 0
+    try:
+        for fp, key in zip(files, keys):
+            if key in cache:
+                r, err = dict(cache[key], file=fp.name), None
+            else:
+                r, err = next(scanned)
+                if r is not None and key is not None:
+                    cache[key] = r
+            if err is not None:
+                logger.error(f'{fp.name}: {err}')
+                print(f'\nERROR [{fp.name}]: {err}')
+                errors += 1
+                continue
             results.append(r)
             issues_total += len(r['issues'])
             if args.json:
-                print(json.dumps(r, ensure_ascii=False, default=str))
+                print(json.dumps(json_result(r), ensure_ascii=False, default=str))
             else:
                 print_result(r)
-        except Exception as e:
-            logger.error(f'{fp.name}: {e}')
-            print(f'\nERROR [{fp.name}]: {e}')
+    finally:
+        if executor:
+            executor.shutdown()
+
+    if not args.no_cache:
+        # Files checked by earlier runs are kept while they exist unchanged, so checking one
+        # file does not forget the rest of the shelf. A result is dropped once no file has its key.
+        files_cache = {path: entry for path, entry in old_cache['files'].items()
+                       if path not in stats and is_unchanged(path, entry)}
+        files_cache.update((path, entry) for path, (_, entry) in stats.items())
+        live = {entry['key'] for entry in files_cache.values()}
+        new_cache = {'results': {key: r for key, r in cache.items() if key in live},
+                     'files': files_cache}
+        if new_cache != old_cache:
+            save_cache(cache_path, new_cache)
 
     if not args.json:
         print(f"\n{'─' * 60}")
         print(f"Checked {len(files)} file(s), {issues_total} issue(s).")
 
+    if args.strict and (issues_total or errors):
+        sys.exit(1)
+
 
 if __name__ == '__main__':
     main()
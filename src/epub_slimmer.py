@@ -1,73 +1,659 @@
+import os
 import sys
 import re
+import time
 import argparse
 import logging
+import posixpath
+import zipfile
+import importlib.util
+from io import BytesIO
 from pathlib import Path
-from typing import Tuple, List, Optional
-from concurrent.futures import ProcessPoolExecutor, as_completed
-from ebooklib import epub
-import ebooklib
-from bs4 import BeautifulSoup
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, NamedTuple, Set, Tuple, List, Optional
+from urllib.parse import quote, unquote
+from concurrent.futures import ThreadPoolExecutor
 
-from utils import read_epub_safe
+from utils import (FONT_MEDIA_TYPES, DocumentLoader, EpubArchive, ManifestItem, Task, add_scheduler_args,
+                   copy_zip_member, declared_encoding, decode_document, html_soup, replace_zip_member,
+                   scheduler_from_args)
+from profiling import StageTimer, write_report
+
+# lxml is only imported by the code that parses documents, and Pillow and fontTools only
+# with --optimize-images, so --help and workers that never need them skip the cost.
+if TYPE_CHECKING:
+    from lxml import etree
 
 logger = logging.getLogger(__name__)
+# The subsetter narrates every table at INFO.
+logging.getLogger('fontTools').setLevel(logging.WARNING)
+
+MEDIA_TAGS = ['img', 'image', 'svg', 'video', 'audio', 'iframe']
+MEDIA_TAG_RE = re.compile(rb'<(?:[\w-]+:)?(?:img|image|svg|video|audio|iframe)\b', re.IGNORECASE)
+FONT_FACE_RE = re.compile(rb'@font-face\s*{[^}]*}', re.DOTALL)
+FONT_EXTENSIONS = ('.ttf', '.otf', '.woff', '.woff2')
+RESOURCE_THREADS = 4
+# Comments and strings are matched whole so braces inside them are not counted; a lone
+# "/*" or quote means the sheet is unterminated and is left alone.
+CSS_TOKEN_RE = re.compile(r'/\*.*?\*/|/\*|"(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])*\'|["\']|\\.|[{};]', re.DOTALL)
+CSS_COMMENT_RE = re.compile(r'/\*.*?\*/', re.DOTALL)
+# Every ".name" anywhere in a sheet, so the set of referenced classes errs on the large side.
+CSS_CLASS_RE = re.compile(r'\.(-?[^\W\d][\w-]*)')
+# Attribute selectors and pseudo-classes/elements with their arguments: never required to match.
+SELECTOR_NOISE_RE = re.compile(r'\[[^\]]*\]|::?[\w-]+(?:\((?:[^()]|\([^()]*\))*\))?')
+SIMPLE_SELECTOR_RE = re.compile(r'([.#]?)(-?[^\W\d][\w-]*)')
+# Selectors whose matches depend on siblings or on every element, which unwrapping could change.
+STRUCTURAL_RE = re.compile(r'[>+~*&]|:(?:not|has|is|where|matches|empty|first-|last-|nth-|only-|root)')
+NESTED_AT_RULES = ('@media', '@supports')
+WRAPPER_TAGS = ('span', 'div')
+BLOCK_TAGS = frozenset([
+    'address', 'article', 'aside', 'blockquote', 'div', 'dl', 'figure', 'footer', 'h1', 'h2', 'h3', 'h4', 'h5',
+    'h6', 'header', 'hr', 'nav', 'ol', 'p', 'pre', 'section', 'table', 'ul',
+])
+
+
+def local_name(el: 'etree._Element') -> str:
+    return el.tag.rpartition('}')[2] if isinstance(el.tag, str) else ''
+
+
+def remove_element(el: 'etree._Element') -> None:
+    # Removes el and everything in it, keeping the text that follows it.
+    parent = el.getparent()
+    if el.tail:
+        prev = el.getprevious()
+        if prev is not None:
+            prev.tail = (prev.tail or '') + el.tail
+        else:
+            parent.text = (parent.text or '') + el.tail
+    parent.remove(el)
+
+
+def unwrap_element(el: 'etree._Element') -> None:
+    # Replaces el with its content.
+    parent = el.getparent()
+    index = parent.index(el)
+    children = list(el)
+    text = (el.text or '') + ('' if children else el.tail or '')
+    if text:
+        prev = el.getprevious()
+        if prev is not None:
+            prev.tail = (prev.tail or '') + text
+        else:
+            parent.text = (parent.text or '') + text
+    if children and el.tail:
+        children[-1].tail = (children[-1].tail or '') + el.tail
+    parent.remove(el)
+    for offset, child in enumerate(children):
+        parent.insert(index + offset, child)
+
+
+def serialize_document(root: 'etree._Element') -> bytes:
+    from lxml import etree
+    tree = root.getroottree()
+    return etree.tostring(tree, encoding=tree.docinfo.encoding or 'utf-8', xml_declaration=True)
+
+
+def remove_media(root: 'etree._Element') -> bool:
+    from lxml import etree
+    found = [el for el in root.iter(etree.Element) if etree.QName(el).localname in MEDIA_TAGS]
+    for el in found:
+        if el.getparent() is not None:
+            remove_element(el)
+    return bool(found)
+
+
+def strip_media_tags(content: bytes, loader: Optional[DocumentLoader] = None) -> bytes:
+    root = (loader or DocumentLoader()).parse_xml(content)
+    if root is None:
+        soup = html_soup(decode_document(content))
+        for tag in soup.find_all(MEDIA_TAGS):
+            tag.decompose()
+        # Kept in its declared encoding; bs4 updates a <meta charset> to match.
+        return soup.encode(declared_encoding(content))
+
+    remove_media(root)
+    return serialize_document(root)
+
+
+def strip_opf_refs(opf: bytes, tag: bytes, attr: bytes, ids: Set[str]) -> bytes:
+    # Cut matching elements out of the raw text so the rest of the OPF stays byte-identical.
+    element_re = re.compile(rb'[ \t]*<(?:[\w-]+:)?' + tag + rb'\b[^>]*>(?:\s*</(?:[\w-]+:)?' + tag + rb'>)?[ \t]*(?:\r?\n)?')
+    attr_re = re.compile(rb'\s' + attr + rb'\s*=\s*["\']([^"\']*)["\']')
+
+    def drop(m: re.Match) -> bytes:
+        ref = attr_re.search(m.group(0))
+        return b'' if ref and ref.group(1).decode('utf-8', 'ignore') in ids else m.group(0)
+
+    return element_re.sub(drop, opf)
+
+
+def patch_opf(opf: bytes, dropped_ids: Iterable[str]) -> bytes:
+    ids = set(dropped_ids)
+    if not ids:
+        return opf
+    opf = strip_opf_refs(opf, rb'item', rb'id', ids)
+    opf = strip_opf_refs(opf, rb'itemref', rb'idref', ids)
+    return strip_opf_refs(opf, rb'meta', rb'content', ids)
+
+
+class OptimizeOptions(NamedTuple):
+    max_dimension: int = 1600
+    quality: int = 80
+
+
+def resource_kind(item: Optional[ManifestItem]) -> str:
+    if item is None:
+        return 'other'
+    if item.is_document:
+        return 'document'
+    if item.media_type == 'text/css' or item.href.lower().endswith('.css'):
+        return 'style'
+    if item.media_type.startswith('image/'):
+        return 'image'
+    if item.media_type in FONT_MEDIA_TYPES or item.media_type.startswith('font/') or \
+            posixpath.splitext(item.href)[1].lower() in FONT_EXTENSIONS:
+        return 'font'
+    return 'media' if item.is_media else 'other'
+
+
+def has_module(name: str) -> bool:
+    # Whether an optional dependency is installed, without paying for its import.
+    return importlib.util.find_spec(name) is not None
+
+
+def optimize_image(data: bytes, options: OptimizeOptions) -> Optional[bytes]:
+    # Re-encoded in its own format, so hrefs and media types stay valid.
+    # EXIF is not carried over, so its orientation is applied to the pixels; the ICC profile
+    # is kept so colour-managed images keep their colours.
+    from PIL import Image, ImageOps
+    with Image.open(BytesIO(data)) as im:
+        fmt = im.format
+        if fmt not in ('JPEG', 'PNG', 'WEBP') or getattr(im, 'is_animated', False):
+            return None
+        im.load()
+        icc_profile = im.info.get('icc_profile')
+        im = ImageOps.exif_transpose(im)
+        if max(im.size) > options.max_dimension:
+            im.thumbnail((options.max_dimension, options.max_dimension), Image.LANCZOS)
+        out = BytesIO()
+        if fmt == 'JPEG':
+            if im.mode not in ('RGB', 'L', 'CMYK'):
+                im = im.convert('RGB')
+            im.save(out, 'JPEG', quality=options.quality, optimize=True, progressive=True, icc_profile=icc_profile)
+        elif fmt == 'PNG':
+            im.save(out, 'PNG', optimize=True, icc_profile=icc_profile)
+        else:
+            im.save(out, 'WEBP', quality=options.quality, method=6, icc_profile=icc_profile)
+    return out.getvalue()
+
+
+def subset_font(data: bytes, chars: Set[int]) -> Optional[bytes]:
+    from fontTools import subset as font_subset
+    from fontTools.ttLib import TTFont
+    font = TTFont(BytesIO(data))
+    opts = font_subset.Options()
+    opts.flavor = font.flavor
+    opts.layout_features = ['*']
+    opts.name_IDs = ['*']
+    opts.name_languages = ['*']
+    opts.notdef_outline = True
+    subsetter = font_subset.Subsetter(opts)
+    subsetter.populate(unicodes=chars)
+    subsetter.subset(font)
+    out = BytesIO()
+    font.save(out)
+    return out.getvalue()
+
+
+def used_characters(archive: EpubArchive, loader: DocumentLoader) -> Set[int]:
+    # Printable ASCII is always kept for generated content such as CSS counters.
+    chars = set(map(chr, range(0x20, 0x7f)))
+    for _, raw in archive.iter_documents(archive.documents()):
+        root = loader.parse(raw)
+        if root is not None:
+            for text in root.itertext():
+                chars.update(text)
+    return set(map(ord, chars))
+
+
+def optimize_resources(archive: EpubArchive, by_name: Dict[str, ManifestItem], options: OptimizeOptions,
+                       loader: DocumentLoader, timer: StageTimer) -> Dict[str, bytes]:
+    jobs = []
+    if has_module('PIL'):
+        jobs += [(name, optimize_image, options) for name, item in by_name.items() if resource_kind(item) == 'image']
+    fonts = [name for name, item in by_name.items() if resource_kind(item) == 'font']
+    if fonts and has_module('fontTools'):
+        with timer.stage('scan_text'):
+            chars = used_characters(archive, loader)
+        jobs += [(name, subset_font, chars) for name in fonts]
+    if not jobs:
+        return {}
+
+    def run(job: Tuple[str, Callable, object]) -> Tuple[str, int, Optional[bytes]]:
+        name, fn, arg = job
+        try:
+            data = archive.zf.read(name)
+            out = fn(data, arg)
+        except Exception as e:
+            logger.debug(f"Keeping {name} as is: {e}")
+            return name, 0, None
+        return name, len(data), out if out is not None and len(out) < len(data) else None
+
+    results = {}
+    # Pillow and fontTools' heavy lifting releases the GIL, so threads keep a worker's CPU busy.
+    with timer.stage('optimize_resources', sum(archive.zf.getinfo(name).file_size for name, _, _ in jobs)):
+        with ThreadPoolExecutor(max_workers=RESOURCE_THREADS) as pool:
+            for name, _, out in pool.map(run, jobs):
+                if out is not None:
+                    results[name] = out
+    return results
+
+
+class StyleIndex(NamedTuple):
+    # What a book's documents contain, for deciding whether a selector can match.
+    tags: Set[str]
+    classes: Set[str]
+    ids: Set[str]
+
+
+def css_blocks(css: str) -> Optional[List[Tuple[int, int, int]]]:
+    # (start, opening brace, end) of every top-level block; start follows the previous block
+    # or statement. None if the sheet is unterminated or its braces do not balance.
+    blocks = []
+    depth = start = brace = 0
+    for m in CSS_TOKEN_RE.finditer(css):
+        token = m.group()
+        if token in ('/*', '"', "'"):
+            return None
+        if token == '{':
+            if depth == 0:
+                brace = m.start()
+            depth += 1
+        elif token == '}':
+            depth -= 1
+            if depth < 0:
+                return None
+            if depth == 0:
+                blocks.append((start, brace, m.end()))
+                start = m.end()
+        elif token == ';' and depth == 0:
+            start = m.end()
+    return blocks if depth == 0 else None
+
 
+def split_selectors(prelude: str) -> List[str]:
+    # Splits on commas outside brackets, parentheses and strings.
+    parts, depth, quote_char, start = [], 0, '', 0
+    for i, c in enumerate(prelude):
+        if quote_char:
+            if c == quote_char:
+                quote_char = ''
+        elif c in '"\'':
+            quote_char = c
+        elif c in '([':
+            depth += 1
+        elif c in ')]':
+            depth -= 1
+        elif c == ',' and depth == 0:
+            parts.append(prelude[start:i].strip())
+            start = i + 1
+    parts.append(prelude[start:].strip())
+    return [p for p in parts if p]
 
-def clean_file(file_path: Path, output_path: Path) -> Tuple[int, int]:
-    book = read_epub_safe(file_path)
-    new_items = []
 
-    for item in book.get_items():
-        if item.get_type() in [ebooklib.ITEM_IMAGE, ebooklib.ITEM_FONT, ebooklib.ITEM_VIDEO, ebooklib.ITEM_AUDIO]:
+def css_selectors(css: str) -> Optional[List[str]]:
+    # Every selector of every style rule, including those nested in @media and @supports.
+    blocks = css_blocks(css)
+    if blocks is None:
+        return None
+    selectors = []
+    for start, brace, end in blocks:
+        prelude = CSS_COMMENT_RE.sub('', css[start:brace]).strip()
+        if prelude.lower().startswith(NESTED_AT_RULES):
+            nested = css_selectors(css[brace + 1:end - 1])
+            if nested is None:
+                return None
+            selectors.extend(nested)
+        elif not prelude.startswith('@'):
+            selectors.extend(split_selectors(prelude))
+    return selectors
+
+
+def selector_types(selector: str) -> Set[str]:
+    return {name.lower() for prefix, name in SIMPLE_SELECTOR_RE.findall(SELECTOR_NOISE_RE.sub('', selector))
+            if not prefix}
+
+
+def may_match(selector: str, index: StyleIndex) -> bool:
+    # False only when the selector needs a tag, class or id that no document has; anything
+    # this cannot read (escapes, namespaces, nesting) is assumed to match.
+    if any(c in selector for c in '\\|&'):
+        return True
+    for prefix, name in SIMPLE_SELECTOR_RE.findall(SELECTOR_NOISE_RE.sub('', selector)):
+        if prefix == '.':
+            found = name in index.classes
+        elif prefix == '#':
+            found = name in index.ids
+        else:
+            found = name.lower() in index.tags
+        if not found:
+            return False
+    return True
+
+
+def prune_css(css: str, index: StyleIndex) -> Optional[str]:
+    # Drops the selectors that cannot match and rules left with none. Everything else,
+    # comments and formatting included, is kept as written.
+    blocks = css_blocks(css)
+    if blocks is None:
+        return None
+    out = []
+    pos = 0
+    for start, brace, end in blocks:
+        head = css[start:brace]
+        prelude = CSS_COMMENT_RE.sub('', head).strip()
+        if prelude.lower().startswith(NESTED_AT_RULES):
+            inner = prune_css(css[brace + 1:end - 1], index)
+            if inner is None or inner == css[brace + 1:end - 1]:
+                continue
+            out.append(css[pos:start])
+            if css_blocks(inner):
+                out.append(css[start:brace + 1] + inner + '}')
+            pos = end
+            continue
+        if prelude.startswith('@'):
+            continue
+        selectors = split_selectors(prelude)
+        kept = [sel for sel in selectors if may_match(sel, index)]
+        if len(kept) == len(selectors):
+            continue
+        out.append(css[pos:start])
+        if kept:
+            out.append(head[:len(head) - len(head.lstrip())] + ', '.join(kept) + ' ')
+            pos = brace
+        else:
+            pos = end
+    out.append(css[pos:])
+    return ''.join(out)
+
+
+def relink_styles(root: 'etree._Element', doc_name: str, merged: Dict[str, str]) -> bool:
+    from lxml import etree
+    # Points links at merged-away sheets to the sheet that was kept, then drops repeated
+    # links to one sheet. The last link is the one kept, since it decides the cascade.
+    base = posixpath.dirname(doc_name)
+    links = []
+    changed = False
+    for el in root.iter(etree.Element):
+        if local_name(el) != 'link' or 'stylesheet' not in (el.get('rel') or '').lower().split():
+            continue
+        href = el.get('href')
+        if not href or ':' in href:
+            continue
+        target = posixpath.normpath(posixpath.join(base, unquote(href.split('#')[0])))
+        if target in merged:
+            target = merged[target]
+            el.set('href', quote(posixpath.relpath(target, base or '.')))
+            changed = True
+        links.append((el, target))
+    seen = set()
+    for el, target in reversed(links):
+        if target in seen:
+            remove_element(el)
+            changed = True
+        seen.add(target)
+    return changed
+
+
+def strip_classes(root: 'etree._Element', referenced: Set[str]) -> bool:
+    from lxml import etree
+    changed = False
+    for el in root.iter(etree.Element):
+        value = el.get('class')
+        if value is None:
+            continue
+        classes = value.split()
+        kept = [c for c in classes if c in referenced]
+        if len(kept) != len(classes):
+            if kept:
+                el.set('class', ' '.join(kept))
+            else:
+                del el.attrib['class']
+            changed = True
+    return changed
+
+
+def collapse_wrappers(root: 'etree._Element', tags: Iterable[str]) -> bool:
+    # Unwraps <span> and <div> elements left without attributes: they carry no style, so
+    # only the structure changes. A <div> goes only if it holds nothing but blocks, so no
+    # text changes the box it sits in. Innermost first, so emptied wrappers go too.
+    from lxml import etree
+    tags = set(tags)
+    changed = False
+    for el in reversed(list(root.iter(etree.Element))):
+        name = local_name(el)
+        if name not in tags or el.attrib or el.getparent() is None:
+            continue
+        if name == 'div' and ((el.text or '').strip() or any(
+                local_name(child) not in BLOCK_TAGS or (child.tail or '').strip() for child in el)):
             continue
+        unwrap_element(el)
+        changed = True
+    return changed
+
+
+def normalize_book(archive: EpubArchive, by_name: Dict[str, ManifestItem], loader: DocumentLoader,
+                   strip_media: bool) -> Tuple[Dict[str, bytes], Dict[str, str]]:
+    # One parse per document builds the book's style index; stylesheets are pruned against
+    # it and documents rewritten against what the sheets reference. Returns the rewritten
+    # members and the merged-away stylesheets (zip name -> manifest id).
+    from lxml import etree
+    index = StyleIndex(set(), set(), set())
+    docs: Dict[str, 'etree._Element'] = {}
+    inline_css: List[str] = []
+    scripted = partial = False
+    changed: Set[str] = set()
+    for name, item in by_name.items():
+        if not item.is_document or name not in archive.zf.NameToInfo:
+            continue
+        raw = archive.zf.read(name)
+        root = loader.parse_xml(raw)
+        if root is None:
+            # Not well-formed: indexed so its selectors stay, but never rewritten.
+            partial = True
+            root = loader.parse_html(raw)
+            if root is None:
+                continue
+        else:
+            docs[name] = root
+            if strip_media and remove_media(root):
+                changed.add(name)
+        for el in root.iter(etree.Element):
+            tag = local_name(el).lower()
+            index.tags.add(tag)
+            if el.get('id'):
+                index.ids.add(el.get('id'))
+            if el.get('class'):
+                index.classes.update(el.get('class').split())
+            if tag == 'style' and el.text:
+                inline_css.append(el.text)
+            elif tag == 'script':
+                scripted = True
+
+    sheets = {name: archive.zf.read(name) for name, item in by_name.items()
+              if resource_kind(item) == 'style' and name in archive.zf.NameToInfo}
+    all_css = [raw.decode('utf-8', 'ignore') for raw in sheets.values()] + inline_css
+    referenced = {c for css in all_css for c in CSS_CLASS_RE.findall(css)}
+    selectors: Optional[List[str]] = []
+    for css in all_css:
+        found = css_selectors(css)
+        if found is None:
+            selectors = None
+            break
+        selectors.extend(found)
+    # Scripts may look elements up by class or position, so their books keep both.
+    collapse = []
+    if selectors is not None and not scripted and not any(STRUCTURAL_RE.search(sel) for sel in selectors):
+        types = set().union(*map(selector_types, selectors))
+        collapse = [tag for tag in WRAPPER_TAGS if tag not in types]
+
+    rewritten: Dict[str, bytes] = {}
+    for name, raw in sheets.items():
+        try:
+            css = raw.decode('utf-8')
+        except UnicodeDecodeError:
+            continue
+        pruned = prune_css(css, index)
+        if pruned is not None and pruned != css:
+            rewritten[name] = pruned.encode('utf-8')
+
+    # Identical sheets are merged unless a document could not be relinked, a sheet imports
+    # another, or relative url()s would resolve differently from the kept sheet's folder.
+    merged: Dict[str, str] = {}
+    if not partial and not any('@import' in css for css in all_css):
+        first: Dict[Tuple[bytes, str], str] = {}
+        for name in sorted(sheets):
+            data = rewritten.get(name, sheets[name])
+            key = (data, posixpath.dirname(name) if b'url(' in data.lower() else '')
+            if key in first:
+                merged[name] = first[key]
+            else:
+                first[key] = name
+
+    for name, root in docs.items():
+        if relink_styles(root, name, merged):
+            changed.add(name)
+        if not scripted and strip_classes(root, referenced):
+            changed.add(name)
+        if collapse and collapse_wrappers(root, collapse):
+            changed.add(name)
+        if name in changed:
+            rewritten[name] = serialize_document(root)
+    for name in merged:
+        rewritten.pop(name, None)
+    return rewritten, {name: by_name[name].id for name in merged}
+
+
+def clean_file(file_path: Path, output_path: Path, timer: Optional[StageTimer] = None,
+               optimize: Optional[OptimizeOptions] = None, normalize: bool = False) -> Tuple[int, int, Dict[str, int]]:
+    # Drops media by default; with optimize, images are recompressed and fonts subset instead.
+    # normalize also prunes the book's CSS and markup. Also returns the compressed bytes
+    # saved per resource kind.
+    timer = timer or StageTimer()
+    tmp_path = output_path.with_name(output_path.name + '.tmp')
+    saved: Dict[str, int] = {}
+    try:
+        with timer.stage('open', file_path.stat().st_size):
+            archive = EpubArchive(file_path)
+        loader = DocumentLoader()
+        with archive, zipfile.ZipFile(tmp_path, 'w') as zout:
+            by_name = {archive.zip_name(item.href): item for item in archive.manifest.values()}
+            if optimize is None:
+                dropped = {name: item.id for name, item in by_name.items() if item.is_media}
+                optimized = {}
+            else:
+                dropped = {}
+                optimized = optimize_resources(archive, by_name, optimize, loader, timer)
+            normalized = {}
+            if normalize:
+                with timer.stage('normalize', sum(archive.zf.getinfo(name).file_size for name, item in by_name.items()
+                                                  if resource_kind(item) in ('document', 'style')
+                                                  and name in archive.zf.NameToInfo)):
+                    normalized, merged = normalize_book(archive, by_name, loader, optimize is None)
+                dropped.update(merged)
+
+            for info in archive.zf.infolist():
+                item = by_name.get(info.filename)
+                kind = resource_kind(item)
+                if info.filename in dropped:
+                    saved[kind] = saved.get(kind, 0) + info.compress_size
+                    continue
+                data = optimized.get(info.filename, normalized.get(info.filename))
+                if info.filename == archive.opf_path:
+                    if optimize is None or dropped:
+                        with timer.stage('read', info.file_size):
+                            raw = archive.zf.read(info)
+                        with timer.stage('opf', len(raw)):
+                            data = patch_opf(raw, dropped.values())
+                elif optimize is not None:
+                    pass
+                elif item is not None and item.is_document:
+                    if data is None:
+                        with timer.stage('read', info.file_size):
+                            raw = archive.zf.read(info)
+                        if MEDIA_TAG_RE.search(raw):
+                            with timer.stage('strip_documents', len(raw)):
+                                try:
+                                    data = strip_media_tags(raw, loader)
+                                except Exception as e:
+                                    logger.warning(f"Failed to clean document content: {e}")
+                elif kind == 'style':
+                    if data is None:
+                        with timer.stage('read', info.file_size):
+                            data = raw = archive.zf.read(info)
+                    else:
+                        raw = None
+                    with timer.stage('strip_css', len(data)):
+                        css = FONT_FACE_RE.sub(b'', data)
+                    data = css if css != raw else None
+
+                if data is None:
+                    with timer.stage('copy_raw', info.compress_size):
+                        copy_zip_member(archive.zf, zout, info)
+                else:
+                    with timer.stage('write', len(data)):
+                        replace_zip_member(zout, info, data)
+                    diff = info.compress_size - zout.getinfo(info.filename).compress_size
+                    saved[kind] = saved.get(kind, 0) + diff
+        os.replace(tmp_path, output_path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
 
-        if item.get_type() == ebooklib.ITEM_DOCUMENT:
-            try:
-                soup = BeautifulSoup(item.get_content().decode('utf-8', 'ignore'), 'lxml')
-                for tag in soup.find_all(['img', 'image', 'svg', 'video', 'audio', 'iframe']):
-                    tag.decompose()
-                item.set_content(str(soup).encode('utf-8'))
-            except Exception as e:
-                logger.warning(f"Failed to clean document content: {e}")
-
-        elif item.get_type() == ebooklib.ITEM_STYLE:
-            try:
-                css = item.get_content().decode('utf-8', 'ignore')
-                css = re.sub(r'@font-face\s*{[^}]*}', '', css, flags=re.DOTALL)
-                item.set_content(css.encode('utf-8'))
-            except Exception as e:
-                logger.warning(f"Failed to clean CSS content: {e}")
-
-        new_items.append(item)
-
-    book.items = new_items
     old_size = file_path.stat().st_size
-    epub.write_epub(str(output_path), book)
     new_size = output_path.stat().st_size
-    return old_size, new_size
+    return old_size, new_size, saved
 
 
-def process_single_file(args: Tuple[Path, Path]) -> Optional[Tuple[str, int, int]]:
-    f_in, f_out = args
+def format_saved(saved: Dict[str, int]) -> str:
+    return ', '.join(f"{kind} {-n / 1024:+,.0f}KB"
+                     for kind, n in sorted(saved.items(), key=lambda x: -x[1]) if round(n / 1024))
+
+
+def process_single_file(args: Tuple[Path, Path, Optional[OptimizeOptions], bool]
+                        ) -> Optional[Tuple[str, int, int, Dict, Dict]]:
+    f_in, f_out, optimize, normalize = args
+    timer = StageTimer(f_in.name)
     try:
         out_dir = f_out.parent
         if out_dir and not out_dir.exists():
             out_dir.mkdir(parents=True, exist_ok=True)
 
-        old_size, new_size = clean_file(f_in, f_out)
-        return (f_in.name, old_size, new_size)
+        old_size, new_size, saved = clean_file(f_in, f_out, timer, optimize, normalize)
+        return (f_in.name, old_size, new_size, timer.stages, saved)
     except Exception as e:
         logger.error(f"Failed {f_in.name}: {e}")
         return None
 
+
 def main() -> None:
-    parser = argparse.ArgumentParser(description='Slim down EPUB files by removing media resources')
+    parser = argparse.ArgumentParser(description='Slim down EPUB files by removing or recompressing media resources')
     parser.add_argument('-i', '--input', required=True, help='Input EPUB file or directory')
     parser.add_argument('-o', '--output', required=True, help='Output EPUB file or directory')
-    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of parallel jobs (default: 1)')
+    add_scheduler_args(parser)
+    parser.add_argument('--optimize-images', action='store_true',
+                        help='Keep images and fonts: downscale and recompress images, subset fonts to the text')
+    parser.add_argument('--max-dimension', type=int, default=OptimizeOptions().max_dimension,
+                        help='Longest image side in pixels with --optimize-images (default: 1600)')
+    parser.add_argument('--quality', type=int, default=OptimizeOptions().quality,
+                        help='JPEG/WebP quality with --optimize-images (default: 80)')
+    parser.add_argument('--normalize', action='store_true',
+                        help='Also drop CSS rules no document uses, merge identical stylesheets, strip unused '
+                             'classes and unwrap bare <span>/<div> wrappers')
+    parser.add_argument('--profile', metavar='PATH',
+                        help='Write per-file, per-stage timings to PATH (.json or .csv)')
     parser.add_argument('-v', '--verbose', action='store_true', help='Enable verbose logging')
     args = parser.parse_args()
+    started = time.perf_counter()
 
     logging.basicConfig(
         level=logging.DEBUG if args.verbose else logging.INFO,
@@ -81,42 +667,60 @@ def main() -> None:
         logger.error(f"Input path does not exist: {input_path}")
         sys.exit(1)
 
-    tasks: List[Tuple[Path, Path]] = []
+    optimize = OptimizeOptions(args.max_dimension, args.quality) if args.optimize_images else None
+    if optimize is not None:
+        if not has_module('PIL'):
+            logger.warning("Pillow is not installed; images are kept as they are")
+        if not has_module('fontTools'):
+            logger.warning("fontTools is not installed; fonts are kept as they are")
+
+    tasks: List[Tuple[Path, Path, Optional[OptimizeOptions], bool]] = []
 
     if input_path.is_file():
         if output_path.suffix.lower() == '.epub':
-            tasks = [(input_path, output_path)]
+            tasks = [(input_path, output_path, optimize, args.normalize)]
         else:
             output_path.mkdir(parents=True, exist_ok=True)
-            tasks = [(input_path, output_path / input_path.name)]
+            tasks = [(input_path, output_path / input_path.name, optimize, args.normalize)]
     elif input_path.is_dir():
         output_path.mkdir(parents=True, exist_ok=True)
         epub_files = list(input_path.glob("*.epub"))
         if not epub_files:
             logger.warning(f"No EPUB files found in {input_path}")
             return
-        tasks = [(f, output_path / f.name) for f in epub_files]
+        tasks = [(f, output_path / f.name, optimize, args.normalize) for f in epub_files]
     else:
         logger.error(f"Invalid input path: {input_path}")
         sys.exit(1)
 
     logger.info(f"Processing {len(tasks)} file(s)...")
+    timers: List[StageTimer] = []
+    total_saved: Dict[str, int] = {}
 
-    if len(tasks) == 1 or args.jobs == 1:
-        for task in tasks:
-            result = process_single_file(task)
-            if result:
-                name, old_size, new_size = result
-                print(f"Processed {name}: {old_size//1024}KB -> {new_size//1024}KB")
-    else:
-        max_workers = min(args.jobs, len(tasks))
-        with ProcessPoolExecutor(max_workers=max_workers) as executor:
-            futures = {executor.submit(process_single_file, task): task for task in tasks}
-            for future in as_completed(futures):
-                result = future.result()
-                if result:
-                    name, old_size, new_size = result
-                    print(f"Processed {name}: {old_size//1024}KB -> {new_size//1024}KB")
+    def report(result: Optional[Tuple[str, int, int, Dict, Dict]]) -> None:
+        if result:
+            name, old_size, new_size, stages, saved = result
+            timer = StageTimer(name)
+            timer.merge(stages)
+            timers.append(timer)
+            for kind, n in saved.items():
+                total_saved[kind] = total_saved.get(kind, 0) + n
+            detail = format_saved(saved)
+            print(f"Processed {name}: {old_size//1024}KB -> {new_size//1024}KB" + (f" ({detail})" if detail else ''))
+
+    scheduler = scheduler_from_args(args)
+    if len(tasks) == 1:
+        scheduler.jobs = 1
+    with scheduler:
+        scheduler.run([Task(process_single_file, task, None, task[0].stat().st_size) for task in tasks],
+                      lambda task, result: report(result))
+
+    if format_saved(total_saved):
+        logger.info(f"Size change by resource type: {format_saved(total_saved)}")
+
+    if args.profile:
+        write_report(Path(args.profile), timers, time.perf_counter() - started)
+        logger.info(f"Wrote profile to {args.profile}")
 
     logger.info("Done!")
 
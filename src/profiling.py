@@ -0,0 +1,112 @@
+import csv
+import sys
+import json
+import time
+import builtins
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, List
+
+
+class StageTimer:
+    # Plain dicts so timings pickle cheaply back from pool workers.
+
+    def __init__(self, name: str = ''):
+        self.name = name
+        self.stages: Dict[str, Dict[str, float]] = {}
+
+    def add(self, stage: str, seconds: float, nbytes: int = 0, calls: int = 1) -> None:
+        s = self.stages.setdefault(stage, {'seconds': 0.0, 'bytes': 0, 'calls': 0})
+        s['seconds'] += seconds
+        s['bytes'] += nbytes
+        s['calls'] += calls
+
+    @contextmanager
+    def stage(self, stage: str, nbytes: int = 0) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start, nbytes)
+
+    def merge(self, stages: Dict[str, Dict[str, float]]) -> None:
+        for stage, s in stages.items():
+            self.add(stage, s['seconds'], s['bytes'], s['calls'])
+
+    @property
+    def seconds(self) -> float:
+        return sum(s['seconds'] for s in self.stages.values())
+
+
+class ImportTimer(StageTimer):
+    # Times the imports made while installed, as one stage per top-level package. A package
+    # is charged only its own time, not that of packages it imports in turn, so the stages
+    # add up to the total; calls counts the modules each package loaded.
+
+    def __init__(self, name: str = 'imports'):
+        super().__init__(name)
+        self.original = builtins.__import__
+        # Time and module count of the imports nested in each import in progress.
+        self.frames: List[List[float]] = []
+
+    def __enter__(self) -> 'ImportTimer':
+        builtins.__import__ = self._import
+        return self
+
+    def __exit__(self, *exc) -> None:
+        builtins.__import__ = self.original
+
+    def _import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        loaded = len(sys.modules)
+        self.frames.append([0.0, 0])
+        start = time.perf_counter()
+        try:
+            return self.original(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = time.perf_counter() - start
+            modules = len(sys.modules) - loaded
+            nested_seconds, nested_modules = self.frames.pop()
+            if self.frames:
+                self.frames[-1][0] += elapsed
+                self.frames[-1][1] += modules
+            if modules:
+                package = (globals or {}).get('__package__') or name if level else name
+                self.add(package.partition('.')[0], elapsed - nested_seconds, calls=modules - nested_modules)
+
+    def summary(self, limit: int = 15) -> str:
+        stages = sorted(self.stages.items(), key=lambda kv: kv[1]['seconds'], reverse=True)
+        lines = [f"Imports: {self.seconds * 1000:.1f} ms, {sum(s['calls'] for _, s in stages)} module(s)"]
+        for package, s in stages[:limit]:
+            lines.append(f"  {s['seconds'] * 1000:8.1f} ms  {package} ({s['calls']} module(s))")
+        return '\n'.join(lines)
+
+
+def write_report(path: Path, timers: List[StageTimer], wall_seconds: float) -> None:
+    books = sorted(timers, key=lambda t: t.seconds, reverse=True)
+    totals = StageTimer('*')
+    for t in books:
+        totals.merge(t.stages)
+
+    def ordered(t: StageTimer) -> List:
+        return sorted(t.stages.items(), key=lambda kv: kv[1]['seconds'], reverse=True)
+
+    if path.suffix.lower() == '.csv':
+        with open(path, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['book', 'stage', 'seconds', 'bytes', 'calls', 'mb_per_s'])
+            for t in [totals] + books:
+                for stage, s in ordered(t):
+                    rate = s['bytes'] / s['seconds'] / 1e6 if s['seconds'] else 0
+                    writer.writerow([t.name, stage, f"{s['seconds']:.6f}", s['bytes'], s['calls'], f'{rate:.2f}'])
+        return
+
+    report = {
+        'wall_seconds': wall_seconds,
+        'stages': [dict(s, stage=stage) for stage, s in ordered(totals)],
+        'books': [
+            {'book': t.name, 'seconds': t.seconds, 'stages': [dict(s, stage=stage) for stage, s in ordered(t)]}
+            for t in books
+        ],
+    }
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=1)
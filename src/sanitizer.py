@@ -0,0 +1,245 @@
+import re
+import codecs
+from typing import Callable, Dict, List, Optional
+
+from utils import decode_document, detect_encoding, html_soup
+
+DROP_TAGS = frozenset(['img', 'image', 'svg', 'style', 'link', 'script'])
+KEEP_ATTRS = frozenset(['href', 'id'])
+
+# Mirrors BeautifulSoup's HTML builder so both engines serialize identically.
+VOID_TAGS = frozenset([
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'keygen', 'link', 'menuitem',
+    'meta', 'param', 'source', 'track', 'wbr', 'basefont', 'bgsound', 'command', 'frame',
+    'image', 'isindex', 'nextid', 'spacer',
+])
+PRESERVE_WS_TAGS = frozenset(['pre', 'textarea'])
+ASCII_SPACES = frozenset('\x20\x0a\x09\x0c\x0d')
+FEED_CHUNK = 64 * 1024
+WS_RUN_RE = re.compile('[\x20\x0a\x09\x0c\x0d]+')
+
+HEADING_TAGS = frozenset(['h1', 'h2', 'h3', 'h4', 'h5', 'h6'])
+BREAK_TAGS = HEADING_TAGS | frozenset([
+    'p', 'div', 'section', 'article', 'blockquote', 'ul', 'ol', 'dl', 'table', 'pre', 'hr', 'figure',
+])
+
+
+def escape_text(s: str) -> str:
+    return s.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def quote_attr(value: str) -> str:
+    value = escape_text(value)
+    if '"' in value:
+        if "'" in value:
+            return '"' + value.replace('"', '&quot;') + '"'
+        return "'" + value + "'"
+    return '"' + value + '"'
+
+
+class Paginator:
+    # Decides where a long chapter is cut into pages: before a block element once the page
+    # is full, or before a heading once it is half full. On its own it only counts, which
+    # is enough to learn the page count and where each id lands before rendering.
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.size = 0
+        self.page = 0
+        self.anchors: Dict[str, int] = {}
+
+    def write(self, s: str) -> None:
+        self.size += len(s)
+
+    def should_break(self, tag: str) -> bool:
+        if not self.limit or tag not in BREAK_TAGS:
+            return False
+        return self.size >= (self.limit // 2 if tag in HEADING_TAGS else self.limit)
+
+    def anchor(self, name: str) -> None:
+        self.anchors.setdefault(name, self.page)
+
+    def next_page(self) -> None:
+        self.page += 1
+        self.size = 0
+
+
+# lxml parser target that writes sanitized <body> contents as events arrive. It sees the
+# same events BeautifulSoup's lxml builder does, so replaying its whitespace and
+# serialization rules gives byte-identical output without building a tree.
+class ChapterSanitizer:
+    def __init__(self, write: Callable[[str], object], on_text: Optional[Callable[[str], object]] = None,
+                 pager: Optional[Paginator] = None, minify: bool = False):
+        self.write = write
+        self.on_text = on_text
+        self.pager = pager
+        self.minify = minify
+        self.stack: List[str] = []
+        # Open tags without their id, to reopen the enclosing elements on a new page.
+        self.reopen: List[str] = []
+        self.text: List[str] = []
+        self.pending: Optional[str] = None
+        self.drop_depth = 0
+        self.preserve_ws = 0
+        self.in_body = False
+        self.seen_body = False
+
+    def _emit_open(self) -> None:
+        if self.pending is not None:
+            self.write('>')
+            self.pending = None
+
+    def _flush(self) -> Optional[str]:
+        if not self.text:
+            return None
+        s = ''.join(self.text)
+        self.text = []
+        if self.preserve_ws:
+            return s
+        if self.minify:
+            return WS_RUN_RE.sub(' ', s)
+        if all(c in ASCII_SPACES for c in s):
+            s = '\n' if '\n' in s else ' '
+        return s
+
+    def _flush_text(self) -> None:
+        s = self._flush()
+        if s is not None:
+            self._emit_open()
+            self.write(escape_text(s))
+            if self.on_text is not None:
+                self.on_text(s)
+
+    def start(self, tag: str, attrib: Dict[str, Optional[str]]) -> None:
+        self._flush_text()
+        if self.drop_depth:
+            self.drop_depth += 1
+        elif tag in DROP_TAGS:
+            self.drop_depth = 1
+        elif self.in_body:
+            self._emit_open()
+            attrs = sorted((k, v) for k, v in attrib.items() if k in KEEP_ATTRS)
+            if self.pager is not None:
+                if not self.preserve_ws and self.pager.should_break(tag):
+                    self._break_page()
+                if attrib.get('id'):
+                    self.pager.anchor(attrib['id'])
+                self.reopen.append('<' + tag + ''.join(
+                    f' {k}' if v is None else f' {k}={quote_attr(v)}' for k, v in attrs if k != 'id') + '>')
+            self.write('<' + tag + ''.join(
+                f' {k}' if v is None else f' {k}={quote_attr(v)}' for k, v in attrs))
+            self.pending = tag
+            self.stack.append(tag)
+            if tag in PRESERVE_WS_TAGS:
+                self.preserve_ws += 1
+        elif tag == 'body' and not self.seen_body:
+            self.in_body = self.seen_body = True
+
+    def end(self, tag: str) -> None:
+        self._flush_text()
+        if self.drop_depth:
+            self.drop_depth -= 1
+            return
+        if not self.in_body:
+            return
+        if not self.stack:
+            self.in_body = False
+            return
+        name = self.stack.pop()
+        if self.pager is not None:
+            self.reopen.pop()
+        if name in PRESERVE_WS_TAGS:
+            self.preserve_ws -= 1
+        if self.pending is not None:
+            self.pending = None
+            self.write('/>' if name in VOID_TAGS else f'></{name}>')
+        else:
+            self.write(f'</{name}>')
+
+    def _break_page(self) -> None:
+        for name in reversed(self.stack):
+            self.write(f'</{name}>')
+        self.pager.next_page()
+        for tag in self.reopen:
+            self.write(tag)
+
+    def data(self, data: str) -> None:
+        if self.in_body and not self.drop_depth:
+            self.text.append(data)
+
+    def _special(self, prefix: str, text: str, suffix: str) -> None:
+        self._flush_text()
+        if self.in_body and not self.drop_depth:
+            self.text.append(text)
+            s = self._flush()
+            self._emit_open()
+            self.write(prefix + s + suffix)
+
+    def comment(self, text: str) -> None:
+        if self.minify:
+            self._flush_text()
+        else:
+            self._special('<!--', text, '-->')
+
+    def pi(self, target: str, data: str) -> None:
+        if self.minify:
+            self._flush_text()
+        else:
+            self._special('<?', target + ' ' + data, '>')
+
+    def close(self) -> bool:
+        self._flush_text()
+        return self.seen_body
+
+
+def sanitize_soup(markup: str, on_text: Optional[Callable[[str], object]] = None) -> str:
+    soup = html_soup(markup)
+
+    for tag in soup.find_all(list(DROP_TAGS)):
+        tag.decompose()
+
+    for tag in soup.find_all():
+        tag.attrs = {key: val for key, val in tag.attrs.items() if key in KEEP_ATTRS}
+
+    root = soup.body or soup
+    if on_text is not None:
+        on_text(root.get_text())
+    return root.decode_contents() if soup.body else str(soup)
+
+
+def stream_lxml(raw: bytes, write: Callable[[str], object],
+                on_text: Optional[Callable[[str], object]] = None, pager: Optional[Paginator] = None,
+                minify: bool = False) -> None:
+    # Decodes and parses in fixed-size chunks and writes output as it is produced, so
+    # memory stays flat however large the chapter is. Unminified, the output is
+    # byte-identical to sanitize_soup.
+    from lxml import etree
+    decoder = codecs.getincrementaldecoder(detect_encoding(raw))('ignore')
+    parser = etree.HTMLParser(target=ChapterSanitizer(write, on_text, pager, minify), recover=True)
+    view = memoryview(raw)
+    started = False
+    for start in range(0, len(view), FEED_CHUNK):
+        text = decoder.decode(view[start:start + FEED_CHUNK])
+        if not started and text:
+            started = True
+            if text[0] == '\ufeff':
+                text = text[1:]
+        if text:
+            parser.feed(text)
+    parser.feed(decoder.decode(b'', final=True))
+    if not parser.close():
+        # Nothing was written without a <body>, so the soup fallback can take over.
+        write(sanitize_soup(decode_document(raw), on_text))
+
+
+def stream_soup(raw: bytes, write: Callable[[str], object],
+                on_text: Optional[Callable[[str], object]] = None, pager: Optional[Paginator] = None,
+                minify: bool = False) -> None:
+    # The bs4 engine always renders a chapter as a single, unminified page.
+    write(sanitize_soup(decode_document(raw), on_text))
+
+
+SANITIZERS: Dict[str, Callable[..., None]] = {
+    'lxml': stream_lxml,
+    'bs4': stream_soup,
+}
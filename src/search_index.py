@@ -0,0 +1,108 @@
+import json
+import re
+from collections import Counter
+from itertools import chain
+from operator import add
+from pathlib import Path
+from typing import Dict, Iterable, List, Mapping
+
+from catalog import BookRecord
+
+SHARD_NAME = 'search.json'
+LIBRARY_INDEX_NAME = 'search-index.json'
+SHARD_VERSION = 2
+
+CJK_CHARS = '\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af'
+WORD_CHARS = '0-9a-z\u00c0-\u024f\u0400-\u04ff'
+CJK_RE = re.compile(f'[{CJK_CHARS}]+')
+WORD_RE = re.compile(f'[{WORD_CHARS}]+')
+# A posting packs the gap since the previous file and the count into one int; counts
+# from COUNT_LIMIT up take an extra int.
+COUNT_LIMIT = 8
+
+
+def count_tokens(counts: Counter, text: str) -> None:
+    # Lowercase words, and CJK runs as bigrams (a lone character counts as itself).
+    runs = CJK_RE.findall(text)
+    counts.update(WORD_RE.findall(text))
+    counts.update(run for run in runs if len(run) == 1)
+    counts.update(chain.from_iterable(map(add, run, run[1:]) for run in runs))
+
+
+class ChapterTokenizer:
+    # Fed text chunks as the sanitizer emits them; the page's text is joined and
+    # tokenized once when it is closed, so words and runs are never split across chunks.
+
+    def __init__(self):
+        self.chunks: List[str] = []
+
+    def feed(self, text: str) -> None:
+        self.chunks.append(text)
+
+    def close(self) -> Counter:
+        counts = Counter()
+        count_tokens(counts, ''.join(self.chunks).lower())
+        self.chunks = []
+        return counts
+
+
+class BookIndex:
+    # Files are numbered in the order they are added, and postings are encoded as they
+    # are added: each entry is (gap since the token's previous file) * COUNT_LIMIT + count,
+    # or that with a zero count followed by the count when it does not fit. write() then
+    # only has to serialize them.
+
+    def __init__(self):
+        self.files: List[str] = []
+        self.postings: Dict[str, List[int]] = {}
+        # token -> position of the last file that has it
+        self.last: Dict[str, int] = {}
+
+    def add(self, out_name: str, counts: Mapping[str, int]) -> None:
+        pos = len(self.files)
+        self.files.append(out_name)
+        postings = self.postings
+        last = self.last
+        for token, n in counts.items():
+            flat = postings.get(token)
+            if flat is None:
+                postings[token] = flat = []
+                gap = pos * COUNT_LIMIT
+            else:
+                gap = (pos - last[token] - 1) * COUNT_LIMIT
+            last[token] = pos
+            if n < COUNT_LIMIT:
+                flat.append(gap + n)
+            else:
+                flat += (gap, n)
+
+    def merge(self, other: 'BookIndex') -> None:
+        # Appends other's files after this index's; only the first entry of each of its
+        # tokens changes, since its gap now counts from this index's last file.
+        offset = len(self.files)
+        self.files.extend(other.files)
+        for token, other_flat in other.postings.items():
+            flat = self.postings.get(token)
+            if flat is None:
+                self.postings[token] = flat = []
+                start = offset
+            else:
+                start = offset - self.last[token] - 1
+            flat.append(other_flat[0] + start * COUNT_LIMIT)
+            flat += other_flat[1:]
+            self.last[token] = other.last[token] + offset
+
+    def write(self, path: Path) -> None:
+        shard = {'v': SHARD_VERSION, 'files': self.files, 'postings': self.postings}
+        # json.dumps builds the string in C; json.dump feeds the file piece by piece.
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(shard, ensure_ascii=False, separators=(',', ':'), sort_keys=True))
+
+
+def write_library_index(output_dir: Path, books: Iterable[BookRecord]) -> None:
+    entries = [
+        {'title': b.title, 'path': b.path, 'shard': str(Path(b.path).parent / SHARD_NAME)}
+        for b in sorted(books, key=lambda b: b.title)
+    ]
+    with open(output_dir / LIBRARY_INDEX_NAME, 'w', encoding='utf-8') as f:
+        json.dump({'v': SHARD_VERSION, 'books': entries}, f, ensure_ascii=False, separators=(',', ':'))
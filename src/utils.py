@@ -1,7 +1,60 @@
+import codecs
+import copy
+import hashlib
 import logging
+import os
+import argparse
+import posixpath
 import re
+import struct
+import sys
+import time
+import warnings
+import zipfile
+from collections import deque
 from pathlib import Path
-from ebooklib import epub
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+from urllib.parse import unquote
+
+# lxml, bs4, ebooklib and the process pool are imported where they are used, so commands
+# and workers that never touch them (--help, a no-op incremental build) skip the cost.
+if TYPE_CHECKING:
+    from concurrent.futures import ProcessPoolExecutor
+    from lxml import etree
+    from bs4 import BeautifulSoup
+    from ebooklib import epub
+
+NAMESPACES = {
+    'CONTAINER': 'urn:oasis:names:tc:opendocument:xmlns:container',
+    'OPF': 'http://www.idpf.org/2007/opf',
+    'DC': 'http://purl.org/dc/elements/1.1/',
+    'NCX': 'http://www.daisy.org/z3986/2005/ncx/',
+}
+DOCUMENT_MEDIA_TYPE = 'application/xhtml+xml'
+MEDIA_EXTENSIONS = frozenset([
+    '.jpg', '.jpeg', '.gif', '.tiff', '.tif', '.png', '.webp', '.otf', '.woff', '.woff2', '.ttf',
+    '.mov', '.mp4', '.avi', '.mp3', '.ogg',
+])
+FONT_MEDIA_TYPES = frozenset([
+    'application/x-font-ttf', 'application/x-font-truetype', 'application/x-font-opentype',
+    'application/font-sfnt', 'application/vnd.ms-opentype', 'application/font-woff',
+    'application/x-font-otf',
+])
+XML_ENCODING_RE = re.compile(rb'<\?xml[^>]*?\sencoding\s*=\s*["\']([\w.:-]+)["\']')
+META_CHARSET_RE = re.compile(rb'<meta\b[^>]*?charset\s*=\s*["\']?([\w.:-]+)', re.IGNORECASE)
+# Estimated peak memory of a task per byte of input, and the share of free memory
+# tasks may use at once by default.
+MEMORY_FACTOR = 8
+MEMORY_BUDGET_SHARE = 0.75
+DEFAULT_MAX_TASKS_PER_CHILD = 32
+PROGRESS_INTERVAL = 5.0
+# Labels Python does not know, and declared codecs that undersell what such files
+# actually contain, so they are read with the superset instead.
+ENCODING_LABELS = {'x-gbk': 'gbk', 'x-gb18030': 'gb18030'}
+SUPERSET_ENCODINGS = {'gb2312': 'gb18030', 'gbk': 'gb18030', 'ascii': 'utf-8'}
+
+
+logger = logging.getLogger(__name__)
 
 
 def setup_logger(name: str, level: int = logging.INFO) -> logging.Logger:
@@ -19,17 +72,293 @@ def natural_sort_key(s: str) -> list:
     return [int(text) if text.isdigit() else text.lower() for text in re.split(r'(\d+)', s)]
 
 
-def read_epub_safe(path: Path) -> epub.EpubBook:
+def file_sha256(path: Path, chunk_size: int = 1 << 20) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def check_epub_path(path: Path) -> None:
     if not path.exists():
         raise FileNotFoundError(f"File not found: {path}")
     if not path.is_file():
         raise ValueError(f"Not a file: {path}")
     if path.suffix.lower() != '.epub':
         raise ValueError(f"Not an EPUB file: {path}")
+
+
+def declared_encoding(raw: bytes) -> str:
+    # BOM first, then the XML declaration or a <meta charset> near the top; UTF-8 otherwise.
+    if raw.startswith(codecs.BOM_UTF8):
+        return 'utf-8'
+    if raw[:2] in (codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE):
+        return 'utf-16'
+    head = raw[:1024]
+    m = XML_ENCODING_RE.match(head) or META_CHARSET_RE.search(head)
+    if m:
+        name = m.group(1).decode('ascii').lower()
+        try:
+            return codecs.lookup(ENCODING_LABELS.get(name, name)).name
+        except LookupError:
+            pass
+    return 'utf-8'
+
+
+def detect_encoding(raw: bytes) -> str:
+    name = declared_encoding(raw)
+    return SUPERSET_ENCODINGS.get(name, name)
+
+
+def decode_document(raw: bytes, encoding: Optional[str] = None) -> str:
+    text = raw.decode(encoding or detect_encoding(raw), 'ignore')
+    return text[1:] if text[:1] == '\ufeff' else text
+
+
+def html_soup(markup: str) -> 'BeautifulSoup':
+    # XHTML is routinely handed to the HTML builder on purpose; silence that warning here
+    # rather than for the whole process.
+    from bs4 import BeautifulSoup, XMLParsedAsHTMLWarning
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', XMLParsedAsHTMLWarning)
+        return BeautifulSoup(markup, 'lxml')
+
+
+class DocumentLoader:
+    # Parses the documents of one book. Raw bytes go straight to the XML parser, which
+    # honours the declared encoding itself; documents that are not well-formed fall back
+    # to lxml's recovering HTML parser. The first XML failure is remembered, so the rest
+    # of that book's documents skip the attempt.
+
+    def __init__(self):
+        from lxml import etree
+        self.xml_parser = etree.XMLParser(resolve_entities=False, huge_tree=True)
+        self.html_parser = etree.HTMLParser(recover=True, huge_tree=True)
+        self.use_xml = True
+
+    def parse_xml(self, raw: bytes) -> Optional['etree._Element']:
+        from lxml import etree
+        if not self.use_xml:
+            return None
+        try:
+            return etree.fromstring(raw, self.xml_parser)
+        except etree.XMLSyntaxError:
+            self.use_xml = False
+            return None
+
+    def parse_html(self, raw: bytes) -> Optional['etree._Element']:
+        self.html_parser.feed(decode_document(raw))
+        return self.html_parser.close()
+
+    def parse(self, raw: bytes) -> Optional['etree._Element']:
+        root = self.parse_xml(raw)
+        return root if root is not None else self.parse_html(raw)
+
+
+def read_epub_safe(path: Path) -> 'epub.EpubBook':
+    from ebooklib import epub
+    check_epub_path(path)
     return epub.read_epub(str(path))
 
 
-def get_epub_title(book: epub.EpubBook, fallback: str = "Unknown") -> str:
+class ManifestItem(NamedTuple):
+    id: str
+    href: str
+    media_type: str
+    properties: Tuple[str, ...]
+
+    @property
+    def is_document(self) -> bool:
+        return self.media_type == DOCUMENT_MEDIA_TYPE
+
+    @property
+    def is_media(self) -> bool:
+        return (self.media_type.split('/', 1)[0] in ('image', 'audio', 'video', 'font')
+                or self.media_type in FONT_MEDIA_TYPES
+                or posixpath.splitext(self.href)[1].lower() in MEDIA_EXTENSIONS)
+
+
+# (title, href relative to the OPF directory, children)
+TocEntry = Tuple[str, str, list]
+
+
+class EpubArchive:
+    # Reads container.xml, the OPF and the TOC up front, but leaves every other member
+    # compressed in the zip until it is asked for, so media is never decompressed.
+
+    def __init__(self, path: Path):
+        check_epub_path(path)
+        self.path = path
+        self.zf = zipfile.ZipFile(path)
+        try:
+            self._load()
+        except Exception:
+            self.zf.close()
+            raise
+
+    def __enter__(self) -> 'EpubArchive':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.zf.close()
+
+    def _load(self) -> None:
+        from lxml import etree
+        container = etree.fromstring(self.zf.read('META-INF/container.xml'))
+        rootfile = container.find('.//{%s}rootfile[@full-path]' % NAMESPACES['CONTAINER'])
+        if rootfile is None:
+            raise ValueError(f"No OPF rootfile in {self.path.name}")
+        self.opf_path = rootfile.get('full-path')
+        self.opf_dir = posixpath.dirname(self.opf_path)
+        opf = etree.fromstring(self.zf.read(self.opf_path))
+
+        self.metadata: Dict[str, List[Tuple[str, Dict[str, str]]]] = {}
+        metadata = opf.find('{%s}metadata' % NAMESPACES['OPF'])
+        for el in metadata if metadata is not None else []:
+            if isinstance(el.tag, str) and el.tag.startswith('{%s}' % NAMESPACES['DC']):
+                name = el.tag[len(NAMESPACES['DC']) + 2:]
+                self.metadata.setdefault(name, []).append((el.text, dict(el.items())))
+
+        self.manifest: Dict[str, ManifestItem] = {}
+        for el in opf.iterfind('{%s}manifest/{%s}item' % (NAMESPACES['OPF'], NAMESPACES['OPF'])):
+            media_type = el.get('media-type', '')
+            if media_type == 'image/jpg':
+                media_type = 'image/jpeg'
+            self.manifest[el.get('id')] = ManifestItem(
+                el.get('id'), unquote(el.get('href', '')), media_type, tuple(el.get('properties', '').split()))
+        self.by_href = {item.href: item for item in self.manifest.values()}
+
+        spine = opf.find('{%s}spine' % NAMESPACES['OPF'])
+        self.spine: List[str] = [el.get('idref') for el in spine] if spine is not None else []
+
+        nav = next((i for i in self.manifest.values() if 'nav' in i.properties), None)
+        ncx = self.manifest.get(spine.get('toc', '')) if spine is not None else None
+        if nav is not None:
+            self.toc = self._parse_nav(nav)
+        elif ncx is not None:
+            self.toc = self._parse_ncx(ncx)
+        else:
+            self.toc = []
+
+    def _parse_ncx(self, item: ManifestItem) -> List[TocEntry]:
+        from lxml import etree
+        base = posixpath.dirname(item.href)
+        ncx = etree.fromstring(self.read(item.href))
+
+        def walk(el) -> List[TocEntry]:
+            entries = []
+            for point in el.iterfind('{%s}navPoint' % NAMESPACES['NCX']):
+                label = point.find('{%s}navLabel/{%s}text' % (NAMESPACES['NCX'], NAMESPACES['NCX']))
+                content = point.find('{%s}content' % NAMESPACES['NCX'])
+                src = content.get('src', '') if content is not None else ''
+                # Relative to the NCX; stored relative to the OPF directory like nav hrefs.
+                href = posixpath.normpath(posixpath.join(base, src)) if src else ''
+                entries.append(((label.text or '') if label is not None else '', href, walk(point)))
+            return entries
+
+        nav_map = ncx.find('{%s}navMap' % NAMESPACES['NCX'])
+        return walk(nav_map) if nav_map is not None else []
+
+    def _parse_nav(self, item: ManifestItem) -> List[TocEntry]:
+        from lxml import html
+        base = posixpath.dirname(item.href)
+        doc = html.document_fromstring(self.read(item.href))
+        navs = doc.xpath("//nav[@*='toc']")
+        if not navs or navs[0].find('ol') is None:
+            return []
+
+        def walk(ol) -> List[TocEntry]:
+            entries = []
+            for li in ol.findall('li'):
+                sub, a = li.find('ol'), li.find('a')
+                href = posixpath.normpath(posixpath.join(base, a.get('href'))) if a is not None and a.get('href') else ''
+                if sub is not None:
+                    entries.append((li[0].text_content(), href, walk(sub)))
+                elif href:
+                    entries.append((a.text_content(), href, []))
+            return entries
+
+        return walk(navs[0].find('ol'))
+
+    def get_metadata(self, namespace: str, name: str) -> List[Tuple[str, Dict[str, str]]]:
+        # Same shape as EpubBook.get_metadata so helpers like get_epub_title accept either.
+        return self.metadata.get(name, []) if namespace == 'DC' else []
+
+    def zip_name(self, href: str) -> str:
+        return posixpath.normpath(posixpath.join(self.opf_dir, href))
+
+    def read(self, href: str) -> bytes:
+        return self.zf.read(self.zip_name(href))
+
+    def size(self, href: str) -> int:
+        return self.zf.getinfo(self.zip_name(href)).file_size
+
+    def item_with_href(self, href: str) -> Optional[ManifestItem]:
+        return self.by_href.get(href)
+
+    def documents(self) -> List[ManifestItem]:
+        return [item for item in self.manifest.values() if item.is_document]
+
+    def spine_documents(self) -> List[ManifestItem]:
+        items = (self.manifest.get(idref) for idref in self.spine)
+        return [item for item in items if item is not None and item.is_document]
+
+    def iter_documents(self, items: Optional[Iterable[ManifestItem]] = None) -> Iterator[Tuple[ManifestItem, bytes]]:
+        for item in self.spine_documents() if items is None else items:
+            yield item, self.read(item.href)
+
+
+def copy_zip_member(src: zipfile.ZipFile, dst: zipfile.ZipFile, info: zipfile.ZipInfo,
+                    chunk_size: int = 1 << 20) -> None:
+    # zipfile has no public raw-copy API, so move the compressed bytes ourselves
+    # the same way ZipFile._open_to_write lays out a member.
+    if info.flag_bits & 0x01:
+        raise ValueError(f"Encrypted member not supported: {info.filename}")
+    src.fp.seek(info.header_offset)
+    name_len, extra_len = struct.unpack('<HH', src.fp.read(zipfile.sizeFileHeader)[26:30])
+    src.fp.seek(name_len + extra_len, 1)
+
+    out = copy.copy(info)
+    out.flag_bits &= ~0x08
+    zip64 = max(out.file_size, out.compress_size) > zipfile.ZIP64_LIMIT
+    dst.fp.seek(dst.start_dir)
+    out.header_offset = dst.fp.tell()
+    dst._writecheck(out)
+    dst._didModify = True
+    dst.fp.write(out.FileHeader(zip64))
+    remaining = info.compress_size
+    while remaining > 0:
+        chunk = src.fp.read(min(chunk_size, remaining))
+        if not chunk:
+            raise zipfile.BadZipFile(f"Truncated member: {info.filename}")
+        dst.fp.write(chunk)
+        remaining -= len(chunk)
+    dst.filelist.append(out)
+    dst.NameToInfo[out.filename] = out
+    dst.start_dir = dst.fp.tell()
+
+
+def replace_zip_member(dst: zipfile.ZipFile, info: zipfile.ZipInfo, data: bytes) -> None:
+    out = zipfile.ZipInfo(info.filename, date_time=info.date_time)
+    out.external_attr = info.external_attr
+    dst.writestr(out, data, compress_type=info.compress_type)
+
+
+def get_epub_metadata(book: 'epub.EpubBook', name: str, fallback: str = '') -> str:
+    try:
+        values = book.get_metadata('DC', name)
+        if values and len(values) > 0 and values[0][0]:
+            return values[0][0].strip()
+    except Exception:
+        pass
+    return fallback
+
+
+def get_epub_title(book: 'epub.EpubBook', fallback: str = "Unknown") -> str:
     try:
         titles = book.get_metadata('DC', 'title')
         if titles and len(titles) > 0:
@@ -37,3 +366,142 @@ def get_epub_title(book: epub.EpubBook, fallback: str = "Unknown") -> str:
     except Exception:
         pass
     return fallback
+
+
+def default_jobs() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def available_memory() -> int:
+    # MemAvailable, capped by a cgroup v2 limit when running in a container; 0 if unknown.
+    available = 0
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    available = int(line.split()[1]) * 1024
+                    break
+    except OSError:
+        try:
+            available = os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+        except (AttributeError, ValueError, OSError):
+            pass
+    try:
+        limit = Path('/sys/fs/cgroup/memory.max').read_text().strip()
+        if limit.isdigit():
+            free = int(limit) - int(Path('/sys/fs/cgroup/memory.current').read_text())
+            available = min(available, free) if available else free
+    except (OSError, ValueError):
+        pass
+    return max(available, 0)
+
+
+class Task(NamedTuple):
+    fn: Callable[[Any], Any]
+    args: Any
+    key: Any = None
+    # Input bytes: orders the queue, estimates memory and weights progress.
+    size: int = 0
+
+
+class Scheduler:
+    # Runs tasks largest first so a big book cannot start last and set the makespan. A task
+    # only starts while the estimated memory of everything running fits the budget (one
+    # task always runs), and workers are replaced every max_tasks_per_child tasks so memory
+    # fragmented by big parses goes back to the OS. Used as a context manager, the pool is
+    # kept warm across run() calls.
+
+    def __init__(self, jobs: int = 0, memory_budget: Optional[int] = None,
+                 max_tasks_per_child: int = DEFAULT_MAX_TASKS_PER_CHILD, memory_factor: int = MEMORY_FACTOR,
+                 unit: str = 'file'):
+        self.jobs = jobs if jobs > 0 else default_jobs()
+        self.memory_budget = (int(available_memory() * MEMORY_BUDGET_SHARE)
+                              if memory_budget is None else memory_budget)
+        self.max_tasks_per_child = max_tasks_per_child
+        self.memory_factor = memory_factor
+        self.unit = unit
+        self.executor: Optional['ProcessPoolExecutor'] = None
+
+    def __enter__(self) -> 'Scheduler':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
+
+    def pool(self) -> 'ProcessPoolExecutor':
+        from concurrent.futures import ProcessPoolExecutor
+        if self.executor is None:
+            kwargs = {}
+            if self.max_tasks_per_child and sys.version_info >= (3, 11):
+                kwargs['max_tasks_per_child'] = self.max_tasks_per_child
+            self.executor = ProcessPoolExecutor(max_workers=self.jobs, **kwargs)
+        return self.executor
+
+    def run(self, tasks: Iterable[Task], handle: Callable[[Task, Any], Optional[List[Task]]]) -> None:
+        # handle() sees each result in completion order and may return follow-up tasks,
+        # which go to the front of the queue so a split book is finished first.
+        queue = deque(sorted(tasks, key=lambda t: t.size, reverse=True))
+        total = [len(queue), sum(t.size for t in queue)]
+        done = [0, 0]
+        started = last_report = time.perf_counter()
+
+        def finished(task: Task, result: Any) -> None:
+            nonlocal last_report
+            more = handle(task, result) or []
+            queue.extendleft(reversed(more))
+            total[0] += len(more)
+            total[1] += sum(t.size for t in more)
+            done[0] += 1
+            done[1] += task.size
+            now = time.perf_counter()
+            if now - last_report >= PROGRESS_INTERVAL and queue:
+                last_report = now
+                share = done[1] / total[1] if total[1] else done[0] / total[0]
+                eta = (now - started) * (1 - share) / share if share else 0
+                logger.info(f"Progress: {done[0]}/{total[0]} {self.unit}(s), {share:.0%} of input, ETA {eta:.0f}s")
+
+        if self.jobs == 1 or not queue:
+            while queue:
+                task = queue.popleft()
+                finished(task, task.fn(task.args))
+            return
+
+        from concurrent.futures import FIRST_COMPLETED, wait
+        executor = self.pool()
+        running = {}
+        used = 0
+        while queue or running:
+            while queue and len(running) < self.jobs:
+                memory = queue[0].size * self.memory_factor
+                if running and self.memory_budget and used + memory > self.memory_budget:
+                    break
+                task = queue.popleft()
+                running[executor.submit(task.fn, task.args)] = (task, memory)
+                used += memory
+            completed, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in completed:
+                task, memory = running.pop(future)
+                used -= memory
+                finished(task, future.result())
+
+
+def add_scheduler_args(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument('-j', '--jobs', type=int, default=0, help='Number of parallel jobs (default: all CPUs)')
+    parser.add_argument('--memory-budget', type=int, metavar='MB',
+                        help='Only start jobs while their estimated memory fits in MB '
+                             f'(default: {MEMORY_BUDGET_SHARE:.0%}% of available memory, 0 for no limit)')
+    parser.add_argument('--max-tasks-per-child', type=int, default=DEFAULT_MAX_TASKS_PER_CHILD, metavar='N',
+                        help=f'Replace each worker after N tasks (default: {DEFAULT_MAX_TASKS_PER_CHILD}, 0 never)')
+
+
+def scheduler_from_args(args: argparse.Namespace, unit: str = 'file') -> Scheduler:
+    budget = None if args.memory_budget is None else args.memory_budget * 1024 * 1024
+    return Scheduler(args.jobs, budget, args.max_tasks_per_child, unit=unit)
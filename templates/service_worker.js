@@ -0,0 +1,115 @@
+// Written to the shelf root as sw.js by epub2html --offline.
+//
+// Every book lists its files and their content hashes in books/<book>/assets.json. Files
+// are cached under their hash, so a rebuilt file is fetched again and an unchanged one
+// never is. The first page read from a book caches the rest of it for offline reading.
+var CACHE_PREFIX = 'book:';
+var SHELF_CACHE = 'shelf';
+var ASSETS_NAME = 'assets.json';
+// How long a loaded assets.json is trusted before it is checked for a rebuild again.
+var ASSETS_TTL = 60 * 1000;
+var BOOK_RE = /^(.*\/books\/[^\/]+\/)/;
+
+var assets = new Map();
+var warmed = new Map();
+
+self.addEventListener('install', function () {
+    self.skipWaiting();
+});
+
+self.addEventListener('activate', function (event) {
+    event.waitUntil(self.clients.claim());
+});
+
+function loadAssets(root) {
+    var entry = assets.get(root);
+    if (entry && Date.now() - entry.loaded < ASSETS_TTL) return entry.promise;
+    var url = root + ASSETS_NAME;
+    var promise = caches.open(CACHE_PREFIX + root).then(function (cache) {
+        return fetch(url, { cache: 'no-cache' }).then(function (r) {
+            if (!r.ok) {
+                // Rebuilt without --offline: forget the book rather than serve stale copies.
+                return caches.delete(CACHE_PREFIX + root).then(function () { return null; });
+            }
+            cache.put(url, r.clone());
+            return r.json();
+        }, function () {
+            return cache.match(url).then(function (r) { return r ? r.json() : null; });
+        });
+    }).then(function (manifest) {
+        if (!manifest) return null;
+        var urls = new Map();
+        Object.keys(manifest.files).forEach(function (name) {
+            urls.set(new URL(name, root).href, manifest.files[name]);
+        });
+        return { version: manifest.version, urls: urls };
+    });
+    assets.set(root, { loaded: Date.now(), promise: promise });
+    return promise;
+}
+
+function cached(cache, url, hash) {
+    var key = url + '?v=' + hash;
+    return cache.match(key).then(function (hit) {
+        return hit || fetch(url, { cache: 'no-cache' }).then(function (r) {
+            if (r.ok) cache.put(key, r.clone());
+            return r;
+        });
+    });
+}
+
+function warm(root, book) {
+    if (!book || warmed.get(root) === book.version) return;
+    warmed.set(root, book.version);
+    return caches.open(CACHE_PREFIX + root).then(function (cache) {
+        var keep = new Set([root + ASSETS_NAME]);
+        var done = Promise.resolve();
+        book.urls.forEach(function (hash, url) {
+            keep.add(url + '?v=' + hash);
+            // One file at a time, so warming stays behind the page the reader is waiting for.
+            done = done.then(function () {
+                return cached(cache, url, hash).catch(function () {});
+            });
+        });
+        return done.then(function () {
+            return cache.keys();
+        }).then(function (keys) {
+            return Promise.all(keys.filter(function (k) { return !keep.has(k.url); }).map(function (k) {
+                return cache.delete(k);
+            }));
+        });
+    });
+}
+
+function networkFirst(request) {
+    return caches.open(SHELF_CACHE).then(function (cache) {
+        return fetch(request).then(function (r) {
+            if (r.ok) cache.put(request, r.clone());
+            return r;
+        }, function () {
+            return cache.match(request).then(function (hit) { return hit || Response.error(); });
+        });
+    });
+}
+
+self.addEventListener('fetch', function (event) {
+    var request = event.request;
+    if (request.method !== 'GET') return;
+    var url = request.url.split('#')[0].split('?')[0];
+    // Shared chapter store files belong to the book whose page asked for them.
+    var match = BOOK_RE.exec(url) || BOOK_RE.exec(request.referrer);
+    if (!match) {
+        if (request.mode === 'navigate') event.respondWith(networkFirst(request));
+        return;
+    }
+    var root = match[1];
+    var book = loadAssets(root);
+    event.respondWith(book.then(function (book) {
+        var hash = book && book.urls.get(url);
+        if (!hash) return fetch(request);
+        return caches.open(CACHE_PREFIX + root).then(function (cache) {
+            return cached(cache, url, hash);
+        });
+    }));
+    event.waitUntil(book.then(function (book) { return warm(root, book); }));
+});
@@ -0,0 +1,55 @@
+import sys
+from pathlib import Path
+
+from ebooklib import epub
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+
+from utils import EpubArchive, read_epub_safe
+from edit_epub import apply_edits, collect_links, edits_for
+
+
+def make_nested_book(path: Path) -> None:
+    book = epub.EpubBook()
+    book.set_identifier('nested')
+    book.set_title('Nested')
+    book.set_language('en')
+    chapters = []
+    for i in range(1, 4):
+        c = epub.EpubHtml(title=f'Chapter {i}', file_name=f'c{i}.xhtml', lang='en')
+        c.content = f'<html><body><h1>Chapter {i}</h1></body></html>'
+        book.add_item(c)
+        chapters.append(c)
+    book.toc = [
+        (epub.Section('Part 1', href='c1.xhtml'), [epub.Link('c1.xhtml', 'Chapter 1', 'c1'),
+                                                   epub.Link('c2.xhtml', 'Chapter 2', 'c2')]),
+        epub.Link('c3.xhtml', 'Chapter 3', 'c3'),
+    ]
+    book.add_item(epub.EpubNcx())
+    book.add_item(epub.EpubNav())
+    book.spine = ['nav'] + chapters
+    epub.write_epub(str(path), book)
+
+
+def editor_listing(path: Path) -> list:
+    links: list = []
+    collect_links(read_epub_safe(path).toc, links)
+    return [link.title for link in links]
+
+
+def test_spec_indices_match_editor_listing(tmp_path):
+    path = tmp_path / 'nested.epub'
+    make_nested_book(path)
+    assert editor_listing(path) == ['Chapter 1', 'Chapter 2', 'Chapter 3']
+
+    edit = edits_for(path.name, {'*': {'chapters': {'0': 'FIRST', '2': 'THIRD'}}})
+    assert apply_edits(path, edit) == 2
+    assert editor_listing(path) == ['FIRST', 'Chapter 2', 'THIRD']
+
+    # The NCX is numbered the same way, and the section label is left alone in both.
+    with EpubArchive(path) as archive:
+        assert [entry[0] for entry in archive.toc] == ['Part 1', 'THIRD']
+        assert [entry[0] for entry in archive.toc[0][2]] == ['FIRST', 'Chapter 2']
+        ncx = next(i for i in archive.manifest.values() if i.media_type == 'application/x-dtbncx+xml')
+        labels = archive.read(ncx.href).decode('utf-8')
+    assert labels.index('Part 1') < labels.index('FIRST') < labels.index('Chapter 2') < labels.index('THIRD')
@@ -0,0 +1,20 @@
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+
+from epub2html import BuildOptions, page_limit
+
+
+def chapter(text: str, encoding: str = 'utf-8') -> bytes:
+    return f'<html><body><p>{text}</p></body></html>'.encode(encoding)
+
+
+def test_page_limit_counts_characters():
+    options = BuildOptions(page_chars=1000)
+    # 600 CJK characters are 1800 bytes in UTF-8 but still fit on one page.
+    assert page_limit(chapter('字' * 600), options) == 0
+    assert page_limit(chapter('字' * 600, 'utf-16'), options) == 0
+    assert page_limit(chapter('字' * 1200), options) == 1000
+    assert page_limit(chapter('a' * 1200), options) == 1000
+    assert page_limit(chapter('字' * 1200), BuildOptions()) == 0
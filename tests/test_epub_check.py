@@ -0,0 +1,59 @@
+import sys
+from pathlib import Path
+
+from ebooklib import epub
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+
+import epub_check
+
+
+def make_book(path: Path, title: str) -> None:
+    book = epub.EpubBook()
+    book.set_identifier(title)
+    book.set_title(title)
+    book.set_language('en')
+    c = epub.EpubHtml(title='Chapter 1', file_name='c1.xhtml', lang='en')
+    c.content = f'<html><body><h1>{title}</h1></body></html>'
+    book.add_item(c)
+    book.toc = [epub.Link('c1.xhtml', 'Chapter 1', 'c1')]
+    book.add_item(epub.EpubNcx())
+    book.add_item(epub.EpubNav())
+    book.spine = ['nav', c]
+    epub.write_epub(str(path), book)
+
+
+def run_check(monkeypatch, cache: Path, *paths: Path) -> list:
+    # Returns the names of the files that were scanned rather than served from the cache.
+    scanned = []
+    check_file = epub_check.check_file
+
+    def counting_check_file(fp):
+        scanned.append(fp.name)
+        return check_file(fp)
+
+    monkeypatch.setattr(epub_check, 'check_file', counting_check_file)
+    monkeypatch.setattr(sys, 'argv', ['epub_check.py', '--json', '--cache', str(cache), *map(str, paths)])
+    epub_check.main()
+    return scanned
+
+
+def test_single_file_check_keeps_shelf_cache(tmp_path, monkeypatch):
+    shelf = tmp_path / 'shelf'
+    shelf.mkdir()
+    for name in ('a', 'b', 'c'):
+        make_book(shelf / f'{name}.epub', name)
+    cache = tmp_path / 'cache.json'
+
+    assert run_check(monkeypatch, cache, shelf) == ['a.epub', 'b.epub', 'c.epub']
+    assert run_check(monkeypatch, cache, shelf / 'b.epub') == []
+    assert run_check(monkeypatch, cache, shelf) == []
+
+    # Removed and changed files drop out of the cache; a changed one is scanned again.
+    (shelf / 'c.epub').unlink()
+    make_book(shelf / 'a.epub', 'a2')
+    assert run_check(monkeypatch, cache, shelf / 'b.epub') == []
+    loaded = epub_check.load_cache(cache)
+    assert [Path(p).name for p in loaded['files']] == ['b.epub']
+    assert len(loaded['results']) == 1
+    assert run_check(monkeypatch, cache, shelf) == ['a.epub']
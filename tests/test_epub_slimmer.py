@@ -0,0 +1,45 @@
+import sys
+from io import BytesIO
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+
+from epub_slimmer import OptimizeOptions, optimize_image
+
+Image = pytest.importorskip('PIL.Image')
+ImageCms = pytest.importorskip('PIL.ImageCms')
+
+ORIENTATION = 0x0112
+
+
+def tagged_image(fmt: str = 'JPEG') -> bytes:
+    # 40x20 pixels, red on the left and blue on the right, stored with "rotate 90° CW"
+    # (orientation 6) and an sRGB profile.
+    im = Image.new('RGB', (40, 20), 'red')
+    im.paste('blue', (20, 0, 40, 20))
+    exif = Image.Exif()
+    exif[ORIENTATION] = 6
+    out = BytesIO()
+    icc = ImageCms.ImageCmsProfile(ImageCms.createProfile('sRGB')).tobytes()
+    im.save(out, fmt, exif=exif.tobytes(), icc_profile=icc, quality=95)
+    return out.getvalue()
+
+
+@pytest.mark.parametrize('fmt', ['JPEG', 'WEBP'])
+def test_optimize_image_keeps_orientation_and_profile(fmt):
+    data = tagged_image(fmt)
+    with Image.open(BytesIO(data)) as original:
+        icc = original.info['icc_profile']
+
+    out = optimize_image(data, OptimizeOptions(max_dimension=30))
+    with Image.open(BytesIO(out)) as im:
+        # Rotated upright and then downscaled; nothing left for a viewer to rotate again.
+        assert im.size == (15, 30)
+        assert im.getexif().get(ORIENTATION, 1) == 1
+        assert im.info.get('icc_profile') == icc
+        rgb = im.convert('RGB')
+        top, bottom = rgb.getpixel((7, 3)), rgb.getpixel((7, 26))
+    assert top[0] > 200 and top[2] < 80
+    assert bottom[2] > 200 and bottom[0] < 80
@@ -0,0 +1,56 @@
+import sys
+from collections import Counter
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+
+from search_index import COUNT_LIMIT, BookIndex
+
+
+def decode(flat: list) -> dict:
+    # Mirrors the search page: file position -> count.
+    found = {}
+    file = -1
+    i = 0
+    while i < len(flat):
+        file += flat[i] // COUNT_LIMIT + 1
+        count = flat[i] % COUNT_LIMIT
+        if not count:
+            i += 1
+            count = flat[i]
+        found[file] = count
+        i += 1
+    return found
+
+
+PAGES = [
+    ('ch1.html', Counter({'中文': 3, 'word': 1})),
+    ('ch2.html', Counter({'中文': 12, 'other': 2})),
+    ('ch3.html', Counter({'word': 9})),
+    ('ch4.html', Counter({'中文': 1, 'word': 1, 'other': 30})),
+    ('ch5.html', Counter()),
+    ('ch6.html', Counter({'word': 2})),
+]
+
+
+def test_postings_round_trip():
+    index = BookIndex()
+    for name, counts in PAGES:
+        index.add(name, counts)
+    assert index.files == [name for name, _ in PAGES]
+    for token in ('中文', 'word', 'other'):
+        assert decode(index.postings[token]) == {pos: c[token] for pos, (_, c) in enumerate(PAGES) if token in c}
+
+
+def test_merged_batches_match_one_index():
+    whole = BookIndex()
+    for name, counts in PAGES:
+        whole.add(name, counts)
+    merged = BookIndex()
+    for batch in (PAGES[:2], PAGES[2:3], PAGES[3:]):
+        part = BookIndex()
+        for name, counts in batch:
+            part.add(name, counts)
+        merged.merge(part)
+    assert merged.files == whole.files
+    assert merged.postings == whole.postings